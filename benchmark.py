@@ -0,0 +1,621 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Micro-benchmarks for the R-NEM building blocks.
+
+Every benchmark is a sacred command, e.g.
+
+    python benchmark.py interactions with bench.K=[2,5,8,12]
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import ctypes
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+from torch.utils.data import DataLoader
+
+from sacred import Experiment
+from datasets import ds, InputDataset, Prefetcher, collate
+from nem_model import (nem, NEMCell, static_nem_iterations, compute_prior, compute_outer_loss,
+                       compute_outer_ub_loss, fused_em_loss, early_exit_nem_iterations, steps_histogram,
+                       restart_nem_iterations)
+from network import net, R_NEM, optimize_for_inference
+from noise import Noise
+from distributed import init_distributed, broadcast_module, AllReduceOptimizer
+
+ex = Experiment("R-NEM-benchmark", ingredients=[ds, nem, net])
+
+M_MMAP_THRESHOLD = -3                                   # mallopt parameter id in glibc
+
+
+# noinspection PyUnusedLocal
+@ex.config
+def cfg():
+    bench = {
+        'K': [2, 5, 8, 12],                             # numbers of components to benchmark
+        'batch_size': 16,
+        'repeats': 10,                                  # timed repetitions per setting
+        'neighbours': 4,                                # partners per object for the sparse interactions
+        'alive': 3,                                     # alive components per sample for the pruning benchmark
+        'checkpoint_steps': [None, 1, 5, 10],           # EM step segment lengths to checkpoint
+        'datasets': None,                               # dataset files to compare (None: <name> and <name>_sm)
+        'usage': 'training',
+        'workers': [0, 1, 2, 4],                        # DataLoader worker counts to compare
+        'prefetch': [0, 1, 2],                          # Prefetcher depths to compare
+        'net_path': None,                               # trained NEMCell weights for the inference benchmarks
+        'restarts': [1, 2, 4, 8],                       # gamma initializations to compare for restart inference
+        'processes': [1, 2, 4, 8],                      # data-parallel process counts for the scaling benchmark
+        'compile_batch_sizes': [1, 2, 4],               # small batch sizes to compare eager and compiled EM steps
+    }
+
+
+def time_it(fn, repeats):
+    """Return the mean wall time of fn() in seconds after one warm-up call."""
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t = time.time()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - t) / repeats
+
+
+def peak_megabytes(fn):
+    """Run fn() and return its peak memory use above the starting point in MB.
+
+    Uses the CUDA allocator statistics if available, otherwise the peak
+    resident set size of the process (Linux/glibc only).
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+        fn()
+        return (torch.cuda.max_memory_allocated() - start) / 2.**20
+
+    def status(key):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) / 2.**10
+
+    # serve tensors from mmap so freed memory leaves the resident set again
+    libc = ctypes.CDLL('libc.so.6')
+    libc.mallopt(M_MMAP_THRESHOLD, 2**16)
+    libc.malloc_trim(0)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    start = status('VmRSS')
+    fn()
+    return status('VmHWM') - start
+
+
+def synthetic_batch(batch_size, nr_steps, shape=(64, 64, 1)):
+    """Random binary features, groups and collisions of shape (T, B, 1, W, H, C)."""
+    size = (nr_steps + 1, batch_size, 1) + tuple(shape)
+    features = torch.bernoulli(0.1 * torch.ones(size))
+    groups = torch.randint(0, 4, size).float() * features
+    collisions = torch.bernoulli(0.5 * torch.ones(size))
+    return features, groups, collisions
+
+
+def saved_megabytes(fn):
+    """Run fn() and return the MB of activations autograd keeps for backward.
+
+    Tensors are counted once per storage, so views are not double counted.
+    On CUDA the peak allocated memory during fn() is returned instead.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+        fn()
+        return (torch.cuda.max_memory_allocated() - start) / 2.**20
+
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values()) / 2.**20
+
+
+def loop_pairs(state1r):
+    """Reference per-object loop that R_NEM.forward used to build (cs, fs)."""
+    b, k = list(state1r.size())[:2]
+    csu = []
+    for i in range(k):
+        selector = [j for j in range(k) if j != i]
+        csu.append(torch.index_select(state1r, 1, torch.LongTensor(selector).to(state1r.device)))
+    cs = torch.stack(csu, dim=1)
+    fs = state1r.view(b, k, 1, -1).repeat(1, 1, k - 1, 1)
+    return torch.cat((cs.view(b*k*(k-1), -1), fs.view(b*k*(k-1), -1)), dim=1)
+
+
+def gather_pairs(cell, state1r):
+    """Vectorized pair construction as done in R_NEM.forward."""
+    b, k = list(state1r.size())[:2]
+    cs = state1r[:, cell._partner_index(k, state1r.device)]
+    fs = state1r.view(b, k, 1, -1).expand_as(cs)
+    return torch.cat((cs, fs), dim=3).view(b*k*(k-1), -1)
+
+
+@ex.command
+def interactions(bench, _config):
+    """Time pairwise interaction construction and a full R_NEM step over K.
+
+    Also compares the dense and factorized interaction engines, in train
+    (batch statistics) and eval (running statistics) mode.
+    """
+    torch.manual_seed(_config['seed'])
+    b = bench['batch_size']
+    print("{:>4} {:>10} {:>10} {:>12} {:>12} {:>12} {:>12} {:>10}".format(
+        'K', 'loop (ms)', 'gather', 'core dense', 'core factor', 'step dense', 'step factor', 'max diff'))
+    for k in bench['K']:
+        if k < 2:
+            continue
+        cell = R_NEM(k, interaction='dense')
+        factorized = R_NEM(k, interaction='factorized')
+        factorized.load_state_dict(cell.state_dict())
+        state1r = torch.rand(b, k, cell.state_size)
+        assert torch.equal(loop_pairs(state1r), gather_pairs(cell, state1r))
+
+        t_loop = time_it(lambda: loop_pairs(state1r), bench['repeats'])
+        t_gather = time_it(lambda: gather_pairs(cell, state1r), bench['repeats'])
+
+        inputs = torch.rand(b * k, 64 * 64)
+        state = torch.rand(b * k, cell.state_size)
+        diff = 0.
+        with torch.no_grad():
+            for train in (True, False):
+                cell.train(train)
+                factorized.train(train)
+                diff = max(diff, float(torch.max(torch.abs(cell(inputs, state)[1] - factorized(inputs, state)[1]))))
+            index = cell._partner_index(k, state1r.device)
+            t_core = time_it(lambda: cell._core_wrapper(gather_pairs(cell, state1r)), bench['repeats'])
+            t_core_factorized = time_it(lambda: factorized._factorized_core(state1r, index), bench['repeats'])
+            t_dense = time_it(lambda: cell(inputs, state), bench['repeats'])
+            t_factorized = time_it(lambda: factorized(inputs, state), bench['repeats'])
+
+        print("{:>4} {:>10.3f} {:>10.3f} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f} {:>10.2e}".format(
+            k, 1000 * t_loop, 1000 * t_gather, 1000 * t_core, 1000 * t_core_factorized,
+            1000 * t_dense, 1000 * t_factorized, diff))
+
+
+@ex.command
+def sparse(bench, _config):
+    """Compare dense and top-m sparse interactions in wall time and memory over K."""
+    torch.manual_seed(_config['seed'])
+    b, m = bench['batch_size'], bench['neighbours']
+    print("{:>4} {:>12} {:>12} {:>12} {:>12}".format('K', 'dense (ms)', 'sparse (ms)', 'dense (MB)', 'sparse (MB)'))
+    for k in bench['K']:
+        if k <= m + 1:
+            continue
+        cell = R_NEM(k)
+        state1r = torch.rand(b, k, cell.state_size, requires_grad=True)
+        dense_index = cell._partner_index(k, state1r.device)
+        sparse_index = torch.argsort(torch.rand(b, k, k - 1), dim=2)[:, :, :m]
+        sparse_index = torch.gather(dense_index.expand(b, k, k - 1), 2, sparse_index)
+
+        t_dense = time_it(lambda: cell._interact(state1r, dense_index), bench['repeats'])
+        t_sparse = time_it(lambda: cell._interact(state1r, sparse_index), bench['repeats'])
+        mb_dense = saved_megabytes(lambda: cell._interact(state1r, dense_index))
+        mb_sparse = saved_megabytes(lambda: cell._interact(state1r, sparse_index))
+
+        print("{:>4} {:>12.3f} {:>12.3f} {:>12.2f} {:>12.2f}".format(
+            k, 1000 * t_dense, 1000 * t_sparse, mb_dense, mb_sparse))
+
+
+@ex.command
+def pruning(bench, _config):
+    """Time an R_NEM inference step over K with all and with only bench.alive components alive."""
+    torch.manual_seed(_config['seed'])
+    b, n = bench['batch_size'], bench['alive']
+    print("{:>4} {:>6} {:>12} {:>12}".format('K', 'alive', 'all (ms)', 'pruned (ms)'))
+    for k in bench['K']:
+        if k <= n:
+            continue
+        cell = R_NEM(k).eval()
+        inputs = torch.rand(b * k, 64 * 64)
+        state = torch.rand(b * k, cell.state_size)
+        alive = torch.argsort(torch.rand(b, k), dim=1) < n
+        with torch.no_grad():
+            t_all = time_it(lambda: cell(inputs, state), bench['repeats'])
+            t_pruned = time_it(lambda: cell(inputs, state, alive=alive), bench['repeats'])
+        print("{:>4} {:>6} {:>12.3f} {:>12.3f}".format(k, n, 1000 * t_all, 1000 * t_pruned))
+
+
+
+@ex.command
+def checkpointing(bench, nem, _config):
+    """Report peak memory and time of one training batch per checkpointing setting."""
+    torch.manual_seed(_config['seed'])
+    features, groups, collisions = synthetic_batch(bench['batch_size'], nem['nr_steps'])
+    settings = [(steps, False) for steps in bench['checkpoint_steps']] + [(None, True)]
+
+    print("{:>16} {:>10} {:>12}".format('checkpoint', 'time (s)', 'peak (MB)'))
+    for steps, modules in settings:
+        nem_cell = NEMCell(R_NEM(nem['k'], checkpoint=modules), input_shape=features.size()[-3:],
+                           distribution=nem['pixel_dist'])
+        optimizer = torch.optim.Adam(nem_cell.parameters())
+
+        def train_batch():
+            static_nem_iterations(nem_cell, features, features, optimizer, True, groups,
+                                  checkpoint_steps=steps, collisions=collisions)
+
+        t = time.time()
+        peak = peak_megabytes(train_batch)
+        name = 'modules' if modules else 'steps={}'.format(steps)
+        print("{:>16} {:>10.2f} {:>12.1f}".format(name, time.time() - t, peak))
+
+
+
+@ex.command
+def fused(bench, nem, _config):
+    """Compare the separate E-step and outer losses with FusedEMLoss per EM step.
+
+    Reports the time of forward and backward and the MB of activations kept
+    for backward, plus the peak memory of a whole training batch.
+    """
+    torch.manual_seed(_config['seed'])
+    b = bench['batch_size']
+    prior = compute_prior(distribution=nem['pixel_dist'])
+
+    print("{:>4} {:>12} {:>12} {:>12} {:>12} {:>10}".format(
+        'K', 'split (ms)', 'fused (ms)', 'split (MB)', 'fused (MB)', 'max diff'))
+    for k in bench['K']:
+        nem_cell = NEMCell(R_NEM(k), input_shape=(64, 64, 1), distribution=nem['pixel_dist'])
+        pred = torch.rand(b, k, 64, 64, 1, requires_grad=True)
+        target = torch.bernoulli(0.1 * torch.ones(b, 1, 64, 64, 1))
+        collision = torch.bernoulli(0.5 * torch.ones(b, 1, 64, 64, 1))
+
+        def split():
+            gamma = nem_cell.e_step(pred, target)
+            total_loss, r_total_loss = compute_outer_loss(pred, gamma, target, prior, nem['pixel_dist'], collision)
+            total_ub_loss, r_total_ub_loss = compute_outer_ub_loss(pred, target, prior, nem['pixel_dist'], collision)
+            return gamma, total_loss, total_ub_loss, r_total_loss, r_total_ub_loss
+
+        def together():
+            return fused_em_loss(pred, target, prior, nem['pixel_dist'], collision)
+
+        diff = max(float(torch.max(torch.abs(x.detach() - y.detach()))) for x, y in zip(split(), together()))
+        t_split = time_it(lambda: sum(split()[1:]).backward(), bench['repeats'])
+        t_fused = time_it(lambda: sum(together()[1:]).backward(), bench['repeats'])
+        mb_split = saved_megabytes(split)
+        mb_fused = saved_megabytes(together)
+        print("{:>4} {:>12.3f} {:>12.3f} {:>12.2f} {:>12.2f} {:>10.2e}".format(
+            k, 1000 * t_split, 1000 * t_fused, mb_split, mb_fused, diff))
+
+    features, groups, collisions = synthetic_batch(b, nem['nr_steps'])
+    print("\n{:>8} {:>10} {:>12}".format('loss', 'time (s)', 'peak (MB)'))
+    for fused_loss in (False, True):
+        nem_cell = NEMCell(R_NEM(nem['k']), input_shape=features.size()[-3:], distribution=nem['pixel_dist'])
+        optimizer = torch.optim.Adam(nem_cell.parameters())
+
+        def train_batch():
+            static_nem_iterations(nem_cell, features, features, optimizer, True, groups,
+                                  fused_loss=fused_loss, collisions=collisions)
+
+        t = time.time()
+        peak = peak_megabytes(train_batch)
+        print("{:>8} {:>10.2f} {:>12.1f}".format('fused' if fused_loss else 'split', time.time() - t, peak))
+
+
+@ex.command
+def early_exit(bench, nem, _config):
+    """Compare inference over all EM steps with early exit of converged samples.
+
+    Runs on a batch of static scenes (the same frame at every step) and on a
+    batch of random frames, and prints how many samples used how many steps.
+    """
+    torch.manual_seed(_config['seed'])
+    features, groups, collisions = synthetic_batch(bench['batch_size'], nem['nr_steps'])
+    nem_cell = NEMCell(R_NEM(nem['k']), input_shape=features.size()[-3:], distribution=nem['pixel_dist'])
+    if bench['net_path']:
+        nem_cell.load_state_dict(torch.load(bench['net_path']))
+    nem_cell.eval()
+
+    print("{:>8} {:>10} {:>12} {:>10}".format('scenes', 'full (s)', 'early (s)', 'mean steps'))
+    for name, data in (('static', features[:1].expand_as(features)), ('random', features)):
+        hidden_state = nem_cell.init_state(bench['batch_size'], nem['k'], dtype=torch.float32)
+
+        def full():
+            with torch.no_grad():
+                static_nem_iterations(nem_cell, data, data, None, False, None, hidden_state=hidden_state)
+
+        t_full = time_it(full, bench['repeats'])
+        t_early = time_it(lambda: early_exit_nem_iterations(nem_cell, data, data, hidden_state=hidden_state),
+                          bench['repeats'])
+        _, steps, _ = early_exit_nem_iterations(nem_cell, data, data, hidden_state=hidden_state)
+        print("{:>8} {:>10.3f} {:>12.3f} {:>10.2f}".format(name, t_full, t_early, float(steps.float().mean())))
+        print("         steps histogram: {}".format(steps_histogram(steps.cpu().numpy(), nem['nr_steps']).tolist()))
+
+
+@ex.command
+def restarts(bench, nem, _config):
+    """Compare sequential runs with restarts folded into the batch, and the mean loss of the best restart."""
+    torch.manual_seed(_config['seed'])
+    features, groups, collisions = synthetic_batch(bench['batch_size'], nem['nr_steps'])
+    nem_cell = NEMCell(R_NEM(nem['k']), input_shape=features.size()[-3:], distribution=nem['pixel_dist'])
+    if bench['net_path']:
+        nem_cell.load_state_dict(torch.load(bench['net_path']))
+    nem_cell.eval()
+
+    def sequential(r):
+        return [restart_nem_iterations(nem_cell, features, features, restarts=1) for _ in range(r)]
+
+    print("{:>8} {:>16} {:>12} {:>10}".format('restarts', 'sequential (s)', 'folded (s)', 'mean loss'))
+    for r in bench['restarts']:
+        t_sequential = time_it(lambda: sequential(r), bench['repeats'])
+        t_folded = time_it(lambda: restart_nem_iterations(nem_cell, features, features, restarts=r), bench['repeats'])
+        _, losses, _ = restart_nem_iterations(nem_cell, features, features, restarts=r)
+        print("{:>8} {:>16.3f} {:>12.3f} {:>10.2f}".format(r, t_sequential, t_folded, float(losses.mean())))
+
+
+@ex.command
+def precision(bench, nem, _config):
+    """Compare the float32 and bfloat16 precision policies of NEMCell.
+
+    Reports the time and peak memory of a training batch, the cosine
+    similarity and relative error of its gradients to float32, and the
+    inference loss and ARI score of the same weights and initial state under
+    each policy, with their difference to float32.
+    """
+    torch.manual_seed(_config['seed'])
+    features, groups, collisions = synthetic_batch(bench['batch_size'], nem['nr_steps'])
+    weights = NEMCell(R_NEM(nem['k']), input_shape=features.size()[-3:], distribution=nem['pixel_dist']).state_dict()
+    if bench['net_path']:
+        weights = torch.load(bench['net_path'])
+
+    print("{:>10} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10} {:>12} {:>10}".format(
+        'precision', 'train (s)', 'peak (MB)', 'grad cos', 'grad err', 'loss', 'ARI', 'loss diff', 'ARI diff'))
+    reference, reference_grad = None, None
+    for p in ('float32', 'bfloat16'):
+        nem_cell = NEMCell(R_NEM(nem['k']), input_shape=features.size()[-3:], distribution=nem['pixel_dist'],
+                           precision=p)
+        nem_cell.load_state_dict(weights)
+        optimizer = torch.optim.SGD(nem_cell.parameters(), lr=0.)
+
+        def train_batch(hidden_state=None):
+            static_nem_iterations(nem_cell, features, features, optimizer, True, groups, collisions=collisions,
+                                  hidden_state=hidden_state)
+
+        # gradients of the first batch, before the BatchNorm statistics change
+        torch.manual_seed(_config['seed'])
+        train_batch(nem_cell.init_state(bench['batch_size'], nem['k'], dtype=torch.float32))
+        grad = torch.cat([param.grad.reshape(-1) for param in nem_cell.parameters() if param.grad is not None])
+        reference_grad = grad if reference_grad is None else reference_grad
+        grad_cos = float(torch.nn.functional.cosine_similarity(grad, reference_grad, 0))
+        grad_err = float(torch.norm(grad - reference_grad) / torch.norm(reference_grad))
+
+        t = time_it(train_batch, bench['repeats'])
+        peak = peak_megabytes(train_batch)
+
+        nem_cell.eval()
+        torch.manual_seed(_config['seed'])
+        hidden_state = nem_cell.init_state(bench['batch_size'], nem['k'], dtype=torch.float32)
+        with torch.no_grad():
+            out = static_nem_iterations(nem_cell, features, features, None, False, groups, collisions=collisions,
+                                        hidden_state=hidden_state)
+        loss, ari = float(out[0]), float(out[4])
+        reference = reference or (loss, ari)
+        print("{:>10} {:>10.3f} {:>12.1f} {:>10.4f} {:>10.2e} {:>10.2f} {:>10.4f} {:>12.2e} {:>10.2e}".format(
+            p, t, peak, grad_cos, grad_err, loss, ari, abs(loss - reference[0]) / abs(reference[0]),
+            abs(ari - reference[1])))
+
+
+@ex.command
+def compiled(bench, nem, _config):
+    """Compare EM steps per second of the eager and the compiled (nem.compile_mode or default) NEMCell.
+
+    Runs inference and training batches at small batch sizes, where the
+    Python overhead of the many small ops of a step dominates. The first calls
+    that compile the step are not timed, their duration is reported as compile.
+    """
+    torch.manual_seed(_config['seed'])
+    weights = NEMCell(R_NEM(nem['k']), input_shape=(64, 64, 1), distribution=nem['pixel_dist']).state_dict()
+    mode = nem['compile_mode'] or 'default'
+
+    print("{:>6} {:>10} {:>12} {:>12} {:>14} {:>14} {:>10}".format(
+        'batch', 'mode', 'compile (s)', 'eval step/s', 'compiled', 'train step/s', 'compiled'))
+    for b in bench['compile_batch_sizes']:
+        features, groups, collisions = synthetic_batch(b, nem['nr_steps'])
+        rates = {}
+        for compile_mode in (None, mode):
+            # compile every batch size from scratch
+            torch._dynamo.reset()
+            nem_cell = NEMCell(R_NEM(nem['k']), input_shape=(64, 64, 1), distribution=nem['pixel_dist'],
+                               compile_mode=compile_mode)
+            nem_cell.load_state_dict(weights)
+            optimizer = torch.optim.SGD(nem_cell.parameters(), lr=0.)
+
+            def infer():
+                with torch.no_grad():
+                    static_nem_iterations(nem_cell, features, features, None, False, groups, collisions=collisions)
+
+            def train():
+                static_nem_iterations(nem_cell, features, features, optimizer, True, groups, collisions=collisions)
+
+            t = time.time()
+            nem_cell.eval()
+            infer()
+            nem_cell.train()
+            train()
+            train()
+            t_compile = time.time() - t
+            rate_train = nem['nr_steps'] / time_it(train, bench['repeats'])
+            nem_cell.eval()
+            rate_eval = nem['nr_steps'] / time_it(infer, bench['repeats'])
+            rates[compile_mode] = (t_compile, rate_eval, rate_train)
+
+        t_compile, rate_eval, rate_train = rates[mode]
+        print("{:>6} {:>10} {:>12.1f} {:>12.1f} {:>14.1f} {:>14.1f} {:>10.1f}".format(
+            b, mode, t_compile, rates[None][1], rate_eval, rates[None][2], rate_train))
+
+
+@ex.command
+def folding(bench, nem, _config):
+    """Compare inference EM steps per second with and without the BatchNorm folded into the layers.
+
+    Also reports the largest difference of the gammas and predictions of the
+    two cells after nem.nr_steps steps.
+    """
+    torch.manual_seed(_config['seed'])
+    nem_cell = NEMCell(R_NEM(nem['k']), input_shape=(64, 64, 1), distribution=nem['pixel_dist']).eval()
+    folded = NEMCell(optimize_for_inference(nem_cell.cell), input_shape=(64, 64, 1),
+                     distribution=nem['pixel_dist']).eval()
+
+    print("{:>6} {:>12} {:>12} {:>12} {:>12}".format('batch', 'eval step/s', 'folded', 'speedup', 'max diff'))
+    for b in bench['compile_batch_sizes'] + [bench['batch_size']]:
+        features, _, _ = synthetic_batch(b, nem['nr_steps'])
+        rates, states = {}, {}
+        for name, cell in (('eval', nem_cell), ('folded', folded)):
+            def infer():
+                torch.manual_seed(_config['seed'])
+                state = cell.init_state(b, nem['k'], dtype=torch.float32)
+                with torch.no_grad():
+                    for t in range(nem['nr_steps']):
+                        state, _ = cell.forward((features[t], features[t+1]), state)
+                states[name] = state
+
+            rates[name] = nem['nr_steps'] / time_it(infer, bench['repeats'])
+        diff = max(float(torch.max(torch.abs(x - y))) for x, y in zip(states['eval'][1:], states['folded'][1:]))
+        print("{:>6} {:>12.1f} {:>12.1f} {:>12.2f} {:>12.2e}".format(
+            b, rates['eval'], rates['folded'], rates['folded'] / rates['eval'], diff))
+
+
+@ex.command
+def loader(bench, dataset, nem):
+    """Measure batch loading throughput for each dataset file layout."""
+    names = bench['datasets'] or [dataset['name'], dataset['name'] + '_sm']
+    out_list = ['features', 'groups', 'collisions']
+
+    print("{:>24} {:>14} {:>12} {:>10}".format('dataset', 'layout', 'batches/s', 'MB/s'))
+    for name in names:
+        data = InputDataset(bench['usage'], bench['batch_size'], out_list, sequence_length=nem['nr_steps'] + 1, name=name)
+        nr_batches = data.limit // data.batch_size
+        t = time.time()
+        nbytes = 0
+        for index in range(nr_batches):
+            nbytes += sum(x.numel() * x.element_size() for x in data[index * data.nr_windows])
+        t = time.time() - t
+        print("{:>24} {:>14} {:>12.2f} {:>10.1f}".format(name, data.layout, nr_batches / t, nbytes / 2.**20 / t))
+
+
+
+@ex.command
+def workers(bench, nem):
+    """Measure batches per second of a full epoch as the number of DataLoader workers grows."""
+    out_list = ['features', 'groups', 'collisions']
+    dataset = InputDataset(bench['usage'], bench['batch_size'], out_list, sequence_length=nem['nr_steps'] + 1)
+
+    print("{:>8} {:>10} {:>12}".format('workers', 'batches', 'batches/s'))
+    for num_workers in bench['workers']:
+        data_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=num_workers,
+                                 collate_fn=collate)
+        t = time.time()
+        nr_batches = sum(1 for _ in data_loader)
+        t = time.time() - t
+        assert nr_batches == len(dataset), (nr_batches, len(dataset))
+        print("{:>8} {:>10} {:>12.2f}".format(num_workers, nr_batches, nr_batches / t))
+
+
+@ex.command
+def prefetch(bench, nem, _config):
+    """Compare an epoch of a training step on prefetched and inline prepared batches."""
+    torch.manual_seed(_config['seed'])
+    out_list = ['features', 'groups', 'collisions']
+    dataset = InputDataset(bench['usage'], bench['batch_size'], out_list, sequence_length=nem['nr_steps'] + 1)
+    data_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=0, collate_fn=collate)
+    device = 'cuda' if torch.cuda.is_available() else None
+    nem_cell = NEMCell(R_NEM(nem['k']), input_shape=dataset.frame_shape, distribution=nem['pixel_dist'])
+    optimizer = torch.optim.Adam(nem_cell.parameters())
+    noise = Noise('bitflip', 0.2, _config['seed'])
+
+    def prepare(data, index):
+        features, groups, collisions = dataset.unpack(data[0])
+        return features, noise(features, [index]), groups, collisions
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        'depth', 'epoch (s)', 'load', 'transfer', 'prepare', 'compute', 'wait'))
+    for depth in bench['prefetch']:
+        batches = Prefetcher(data_loader, prepare, device, depth)
+        compute = 0.
+        t = time.time()
+        for features, corrupted, groups, collisions in batches:
+            t1 = time.time()
+            static_nem_iterations(nem_cell, corrupted, features, optimizer, True, groups, collisions=collisions)
+            compute += time.time() - t1
+        t = time.time() - t
+        print("{:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            depth, t, batches.timings['load'], batches.timings['transfer'], batches.timings['prepare'],
+            compute, batches.timings['wait']))
+
+
+@ex.command
+def scaling_worker(bench, nem, _config):
+    """One process of the scaling benchmark, started by scaling with the torchrun environment."""
+    rank, world_size = init_distributed()
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(_config['seed'] + rank)
+    features, groups, collisions = synthetic_batch(bench['batch_size'], nem['nr_steps'])
+    nem_cell = NEMCell(R_NEM(nem['k']), input_shape=features.size()[-3:], distribution=nem['pixel_dist'])
+    broadcast_module(nem_cell)
+    optimizer = AllReduceOptimizer(torch.optim.Adam(nem_cell.parameters()))
+
+    def train_batch():
+        static_nem_iterations(nem_cell, features, features, optimizer, True, groups, collisions=collisions)
+
+    train_batch()
+    t = time_it(train_batch, bench['repeats'])
+    if rank == 0:
+        print(json.dumps({'step': t}))
+
+
+@ex.command
+def scaling(bench, _config):
+    """Weak scaling of data-parallel training over bench.processes processes on this host.
+
+    Every process trains on its own batch of bench.batch_size samples and the
+    gradients are all-reduced with gloo, so the samples per second should grow
+    with the number of processes up to the number of cores.
+    """
+    config = {key: _config[key] for key in ('bench', 'nem', 'network', 'dataset', 'seed')}
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(config, f)
+
+    try:
+        print("{:>10} {:>10} {:>12} {:>10}".format('processes', 'step (s)', 'samples/s', 'speedup'))
+        base = None
+        for n in bench['processes']:
+            port = 29500 + n
+            workers = []
+            for rank in range(n):
+                env = dict(os.environ, MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank),
+                           LOCAL_RANK=str(rank), WORLD_SIZE=str(n))
+                workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), 'scaling_worker', 'with',
+                                                 f.name, '--loglevel=ERROR'], env=env, stdout=subprocess.PIPE,
+                                                universal_newlines=True))
+            outputs = [w.communicate()[0] for w in workers]
+            if any(w.returncode for w in workers):
+                raise RuntimeError('scaling_worker failed with {} processes'.format(n))
+            step = json.loads(outputs[0].strip().splitlines()[-1])['step']
+            throughput = n * bench['batch_size'] / step
+            base = base or throughput / n
+            print("{:>10} {:>10.3f} {:>12.1f} {:>10.2f}".format(n, step, throughput, throughput / base))
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == '__main__':
+    ex.run_commandline()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Rewrite a dataset file into a sample-major, chunk-aligned layout.
+
+The source files store every split as (T, N, W, H, C), so reading one batch
+gathers T strided hyperslabs. The converted file stores (N, T, W, H, C) with
+one chunk per batch_size samples, which InputDataset reads in one contiguous
+read. Binary datasets can be stored as packed bits and integer ones as small
+integer types; the loader ships them as is and they are only converted to
+float after the transfer to the device, e.g.
+
+    python convert.py with dataset.name=balls4mass64 batch_size=16 \
+        "pack_bits=['features', 'collisions']" "compact=['groups']"
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os
+import h5py
+import numpy as np
+
+from sacred import Experiment
+from datasets import ds, SAMPLE_MAJOR
+
+ex = Experiment("R-NEM-convert", ingredients=[ds])
+
+
+# noinspection PyUnusedLocal
+@ex.config
+def cfg():
+    output_name = None                                  # name of the converted file (None: <name>_sm)
+    batch_size = 16                                     # samples per chunk, use the training batch size
+    compression = None                                  # optional filter {None, lzf, gzip}
+    usages = ['training', 'validation', 'test']         # splits to convert
+    pack_bits = []                                      # binary datasets to store one bit per pixel, e.g. ['features']
+    compact = []                                        # integer datasets to store as small ints, e.g. ['groups']
+
+
+def compact_dtype(data, batch_size):
+    """Smallest unsigned integer type holding all values of data."""
+    high = 0
+    for start in range(0, data.shape[1], batch_size):
+        block = data[:, start:start + batch_size]
+        if np.any(block < 0) or np.any(block != np.round(block)):
+            raise ValueError('{} does not hold non-negative integers'.format(data.name))
+        high = max(high, int(block.max()))
+    return np.min_scalar_type(high)
+
+
+def convert_split(src, dst, batch_size, compression, pack_bits, compact):
+    for data_name, data in src.items():
+        T, N = data.shape[:2]
+        frame_shape = data.shape[2:]
+        if data_name in pack_bits:
+            # one bit per pixel, frames flattened and padded to whole bytes
+            shape, dtype = (N, T, (int(np.prod(frame_shape)) + 7) // 8), np.uint8
+        elif data_name in compact:
+            shape, dtype = (N, T) + frame_shape, compact_dtype(data, batch_size)
+        else:
+            shape, dtype = (N, T) + frame_shape, data.dtype
+
+        out = dst.create_dataset(data_name, shape=shape, dtype=dtype,
+                                 chunks=(min(batch_size, N),) + shape[1:], compression=compression)
+        for start in range(0, N, batch_size):
+            stop = min(start + batch_size, N)
+            block = np.swapaxes(data[:, start:stop], 0, 1)
+            if data_name in pack_bits:
+                if np.any((block != 0) & (block != 1)):
+                    raise ValueError('{} is not binary and cannot be bit-packed'.format(data.name))
+                block = np.packbits(block.reshape(block.shape[:2] + (-1,)).astype(np.uint8), axis=-1)
+            out[start:stop] = block.astype(dtype, copy=False)
+
+        if data_name in pack_bits:
+            out.attrs['packed_shape'] = frame_shape
+        print('    {}: {} {} -> {} {}'.format(data_name, data.shape, data.dtype, shape, np.dtype(dtype)))
+
+
+@ex.automain
+def run(dataset, output_name, batch_size, compression, usages, pack_bits, compact):
+    src_path = os.path.join(dataset['path'], dataset['name'] + '.h5')
+    dst_path = os.path.join(dataset['path'], (output_name or dataset['name'] + '_sm') + '.h5')
+
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        dst.attrs['layout'] = SAMPLE_MAJOR
+        for usage in usages:
+            if usage not in src:
+                continue
+            print(usage)
+            convert_split(src[usage], dst.create_group(usage), batch_size, compression, pack_bits, compact)
+
+    print('Saved to:', os.path.abspath(dst_path))
+    return dst_path
@@ -2,15 +2,27 @@
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals, absolute_import
 import os
+import glob
+import time
+import queue
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing.util import Finalize
 import h5py
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 from sacred import Ingredient
 
 ds = Ingredient('dataset')
 
+# file layouts: the original (T, N, W, H, C) files and the output of convert.py, (N, T, W, H, C)
+TIME_MAJOR = 'time_major'
+SAMPLE_MAJOR = 'sample_major'
+
 
 @ds.config
 def cfg():
@@ -19,45 +31,548 @@ def cfg():
     train_size = None           # subset of training set (None, int)
     valid_size = 1000           # subset of valid set (None, int)
     test_size = None            # subset of test set (None, int)
+    stream = False              # walk whole sequences in consecutive windows of sequence_length frames
+    shuffle = None              # shuffle training batches, e.g. {'block_size': 64, 'buffer_blocks': 8}
+    cache = None                # keep splits in shared memory, e.g. {'chunk_size': 64, 'budget_mb': 4096} (budget per process)
 
 
 ds.add_named_config('balls4mass64', {'name': 'balls4mass64'})
 ds.add_named_config('balls678mass64', {'name': 'balls678mass64'})
 ds.add_named_config('balls3curtain64', {'name': 'balls3curtain64'})
 ds.add_named_config('atari', {'name': 'atari'})
+ds.add_named_config('shuffled', {'shuffle': {'block_size': 64, 'buffer_blocks': 8}})
+ds.add_named_config('cached', {'cache': {'chunk_size': 64, 'budget_mb': 4096}})
 
 
 class InputDataset(Dataset):
     @ds.capture
-    def _open_dataset(self, out_list, path, name):
-        # open dataset file
-        self._hdf5_file = h5py.File(os.path.join(path, name + '.h5'), 'r')
-        self._data_in_file = {
-            data_name: self._hdf5_file[self.usage][data_name] for data_name in out_list
+    def _open_dataset(self, out_list, path, name, stream, shuffle, cache, train_size, valid_size, test_size):
+        # read the metadata, the file itself is opened lazily in every process
+        self._path = os.path.join(path, name + '.h5')
+        self._out_list = list(out_list)
+        self._hdf5_file, self._pid = None, None
+        data_in_file = self._data_in_file
+
+        self.layout = self._hdf5_file.attrs.get('layout', TIME_MAJOR)
+        if isinstance(self.layout, bytes):
+            self.layout = self.layout.decode()
+
+        # bit-packed datasets and their unpacked (W, H, C) frame shapes
+        self.packed = {
+            data_name: tuple(ds.attrs['packed_shape']) for data_name, ds in data_in_file.items()
+            if 'packed_shape' in ds.attrs
         }
-        
-        print(self._data_in_file['features'].shape, self._data_in_file['groups'].shape, self._data_in_file['collisions'].shape)
-        self.limit = self._data_in_file['features'].shape[1]
+        features_shape = data_in_file['features'].shape
+        self.frame_shape = self.packed.get('features', tuple(features_shape[-3:]))
 
-    def __init__(self, usage, batch_size, out_list=('features', 'groups'), sequence_length=31):
-        
+        print(*[ds.shape for ds in data_in_file.values()])
+        time_axis, sample_axis = (1, 0) if self.layout == SAMPLE_MAJOR else (0, 1)
+        self.limit = features_shape[sample_axis]
+        size = {'training': train_size, 'validation': valid_size, 'test': test_size}.get(self.usage)
+        if size is not None:
+            self.limit = min(self.limit, size)
+
+        # consecutive windows share one frame, the last target of a window is the next first input
+        total_length = features_shape[time_axis]
+        self.nr_windows = (total_length - 1) // (self.sequence_length - 1) if stream else 1
+
+        # blocks of contiguous samples read as a whole and kept in memory for shuffled batches
+        self.shuffle = shuffle
+        self.block_size = shuffle['block_size'] if shuffle else None
+        self._blocks = OrderedDict()
+        self.cache = cache
+
+        # do not hand an open file over to forked DataLoader workers
+        self._close()
+
+    @property
+    def _data_in_file(self):
+        """The datasets in the file, opened on first use in each process."""
+        if self._hdf5_file is None or self._pid != os.getpid():
+            self._hdf5_file = h5py.File(self._path, 'r')
+            self._pid = os.getpid()
+            self._datasets = {
+                data_name: self._hdf5_file[self.usage][data_name] for data_name in self._out_list
+            }
+        return self._datasets
+
+    def _close(self):
+        if self._hdf5_file is not None and self._pid == os.getpid():
+            self._hdf5_file.close()
+        self._hdf5_file, self._pid, self._datasets = None, None, None
+
+    def __getstate__(self):
+        # file handles cannot be pickled, e.g. for spawned workers
+        state = dict(self.__dict__)
+        state.update(_hdf5_file=None, _pid=None, _datasets=None, _blocks=OrderedDict())
+        return state
+
+    def __init__(self, usage, batch_size, out_list=('features', 'groups'), sequence_length=31, **options):
+        """options override the dataset config, e.g. name='balls4mass64_sm'."""
         self.usage = usage
         self.sequence_length = sequence_length
         self.batch_size = batch_size
         
         # with tf.name_scope("{}_queue".format(usage[:5])):
 
-        self._open_dataset(out_list)
+        self._open_dataset(out_list, **options)
 
     def __len__(self):
-        return 3
-        #return int(self.limit/self.batch_size)
+        return int(self.limit/self.batch_size) * self.nr_windows
 
     def __getitem__(self, index):
-        data = [torch.from_numpy(ds[:self.sequence_length, self.batch_size*index:(index + 1)*self.batch_size][:, :, None].astype(np.float32))
+        """Return the batch index, or the (samples, window) batch of a BlockShuffleSampler."""
+        if isinstance(index, tuple):
+            return self._get_samples(*index)
+
+        # all windows of a batch are served in order before the next batch
+        batch, window = divmod(index, self.nr_windows)
+        start = window * (self.sequence_length - 1)
+        data = [torch.from_numpy(self._read(ds, slice(self.batch_size*batch, (batch + 1)*self.batch_size),
+                                            slice(start, start + self.sequence_length))[:, :, None])
                      for data_name, ds in self._data_in_file.items()]
         return data
 
+    def _get_samples(self, samples, window):
+        """Assemble a batch of arbitrary samples from the in-memory blocks."""
+        start = window * (self.sequence_length - 1)
+        blocks = [self._block(block) for block in np.asarray(samples) // self.block_size]
+        offsets = np.asarray(samples) % self.block_size
+        data = [torch.from_numpy(np.stack([block[i][start:start + self.sequence_length, offset]
+                                           for block, offset in zip(blocks, offsets)], axis=1)[:, :, None])
+                for i in range(len(self._out_list))]
+        return data
+
+    def _block(self, block):
+        """Return all used frames of a block of samples for every dataset, kept in an LRU."""
+        if block in self._blocks:
+            self._blocks.move_to_end(block)
+            return self._blocks[block]
+
+        data = [self._read_block(ds, block) for ds in self._data_in_file.values()]
+
+        # room for the current buffer and the samples carried over from the previous one
+        self._blocks[block] = data
+        while len(self._blocks) > 2 * self.shuffle['buffer_blocks']:
+            self._blocks.popitem(last=False)
+        return data
+
+    def _block_shape(self, ds, block):
+        """Shape and dtype of _read_block(ds, block)."""
+        nr_frames = self.nr_windows * (self.sequence_length - 1) + 1
+        nr_samples = min((block + 1) * self.block_size, self.limit) - block * self.block_size
+        dtype = np.float32 if np.issubdtype(ds.dtype, np.floating) else ds.dtype
+        return (nr_frames, nr_samples) + ds.shape[2:], np.dtype(dtype)
+
+    def _read_block(self, ds, block):
+        """Read all used frames of a block of samples in one piece, (T, block_size, ...)."""
+        nr_frames = self.nr_windows * (self.sequence_length - 1) + 1
+        samples = slice(block * self.block_size, min((block + 1) * self.block_size, self.limit))
+        return self._read(ds, samples, slice(0, nr_frames))
+
+    def _read(self, ds, samples, frames):
+        """Read the given samples and frames of ds as (T, B, W, H, C).
+
+        Float data is returned as float32. Integer and bit-packed data keep their
+        compact type until unpack() is called, usually on the device.
+        """
+        if self.layout == SAMPLE_MAJOR:
+            # a single contiguous read of whole chunks
+            data = np.swapaxes(ds[samples, frames], 0, 1)
+        else:
+            data = ds[frames, samples]
+        dtype = np.float32 if np.issubdtype(data.dtype, np.floating) else data.dtype
+        # transposes and converts in a single copy, no copy if already float32 (T, B, ...)
+        return np.ascontiguousarray(data, dtype=dtype)
+
+    def unpack(self, data, device=None):
+        """Move a batch from __getitem__ to device and convert it to float tensors.
+
+        Bit-packed and integer data is transferred in its compact form and only
+        expanded to float32 on the device.
+        """
+        out = []
+        for data_name, x in zip(self._out_list, data):
+            if device is not None:
+                x = x.to(device, non_blocking=True)
+            if data_name in self.packed:
+                x = unpack_bits(x, self.packed[data_name])
+            out.append(x.float())
+        return out
+
+
+class CachedInputDataset(InputDataset):
+    """InputDataset that keeps the split in shared memory.
+
+    The split is cut into chunks of chunk_size samples holding all used frames
+    of every dataset. Each chunk is read from the HDF5 file once and written to
+    a file in shared memory (/dev/shm), which the DataLoader workers of this
+    run and other runs on the same host on the same file memory-map instead of
+    reading it again. Every process keeps at most budget_mb of chunks mapped
+    and evicts the least recently used ones beyond that, so splits larger than
+    the budget are streamed through the cache. The budget is per process, not
+    per host: every DataLoader worker and every run maps up to budget_mb.
+    Evicted chunks are removed by the process that wrote them. Every run
+    registers itself with the chunks of its settings, and the last run to
+    exit removes all of them; processes still mapping them keep their copy.
+    The chunks of runs that died without removing them are swept when the
+    next cached dataset is set up. A chunk file whose size does not match
+    the expected shape is rebuilt.
+    With shuffle, chunk_size must equal the shuffle block_size, as the chunks
+    are the blocks BlockShuffleSampler groups its batches by.
+    """
+    @staticmethod
+    def _shm_dir():
+        return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    def _open_cache(self):
+        if self.shuffle:
+            assert self.shuffle['block_size'] == self.cache['chunk_size'], \
+                'the cache chunk_size must equal the shuffle block_size'
+        self.block_size = self.cache['chunk_size']
+        self._budget = self.cache['budget_mb'] * 2**20
+        self._chunks = OrderedDict()    # chunk -> (arrays, whether this process wrote them)
+        self._nbytes = 0
+        nr_frames = self.nr_windows * (self.sequence_length - 1) + 1
+        stamp = '{}:{}:{}:{}:{}:{}'.format(os.path.abspath(self._path), os.path.getmtime(self._path), self.usage,
+                                           self.limit, self.block_size, nr_frames)
+        self._key = hashlib.sha1(stamp.encode()).hexdigest()[:20]
+        _sweep_stale_chunks(self._shm_dir(), self._key)
+
+        # the process that sets up the dataset holds a reference to the chunks until it is done
+        refs = os.path.join(self._shm_dir(), 'rnem_{}.refs'.format(self._key))
+        os.makedirs(refs, exist_ok=True)
+        open(os.path.join(refs, str(os.getpid())), 'w').close()
+        nr_blocks = (self.limit + self.block_size - 1) // self.block_size
+        paths = [self._chunk_path(data_name, block) for data_name in self._out_list for block in range(nr_blocks)]
+        Finalize(self, _release_chunks, args=(refs, os.getpid(), paths), exitpriority=0)
+
+    def __init__(self, usage, batch_size, out_list=('features', 'groups'), sequence_length=31, **options):
+        super(CachedInputDataset, self).__init__(usage, batch_size, out_list, sequence_length, **options)
+        self._open_cache()
+
+    def __getstate__(self):
+        state = super(CachedInputDataset, self).__getstate__()
+        state.update(_chunks=OrderedDict(), _nbytes=0)
+        return state
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self._get_samples(*index)
+        batch, window = divmod(index, self.nr_windows)
+        return self._get_samples(range(self.batch_size*batch, (batch + 1)*self.batch_size), window)
+
+    def _get_samples(self, samples, window):
+        data = super(CachedInputDataset, self)._get_samples(samples, window)
+        while self._nbytes > self._budget and len(self._chunks) > 1:
+            self._evict()
+        return data
+
+    def _chunk_path(self, data_name, block):
+        stamp = '{}:{}'.format(data_name, block)
+        return os.path.join(self._shm_dir(), 'rnem_{}_{}'.format(self._key, hashlib.sha1(stamp.encode()).hexdigest()[:20]))
+
+    def _block(self, block):
+        if block in self._chunks:
+            self._chunks.move_to_end(block)
+            return self._chunks[block][0]
+
+        arrays, written = [], []
+        for data_name, ds in self._data_in_file.items():
+            path = self._chunk_path(data_name, block)
+            shape, dtype = self._block_shape(ds, block)
+            if not os.path.exists(path) or os.path.getsize(path) != int(np.prod(shape)) * dtype.itemsize:
+                # write under a private name and publish atomically, concurrent writers are harmless
+                tmp = '{}.{}.tmp'.format(path, os.getpid())
+                self._read_block(ds, block).tofile(tmp)
+                os.rename(tmp, path)
+                written.append(path)
+            try:
+                arrays.append(np.memmap(path, dtype=dtype, mode='r', shape=shape))
+            except (FileNotFoundError, ValueError):
+                # removed in the meantime by its writer
+                arrays.append(self._read_block(ds, block))
+            self._nbytes += arrays[-1].nbytes
+        self._chunks[block] = (arrays, written)
+        return arrays
+
+    def _evict(self):
+        block, (arrays, written) = self._chunks.popitem(last=False)
+        self._nbytes -= sum(array.nbytes for array in arrays)
+        _remove_all(written)
+
+
+def _remove_all(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _sweep_stale_chunks(shm_dir, key):
+    """Remove the chunks of other settings whose runs all died without releasing them."""
+    for refs in glob.glob(os.path.join(shm_dir, 'rnem_*.refs')):
+        other = os.path.basename(refs)[len('rnem_'):-len('.refs')]
+        try:
+            holders = [int(name) for name in os.listdir(refs) if name.isdigit()]
+        except FileNotFoundError:
+            continue
+        # a run that just created the directory has not registered yet
+        if other == key or not holders or any(_process_alive(p) for p in holders):
+            continue
+        _remove_all(glob.glob(os.path.join(shm_dir, 'rnem_{}_*'.format(other))))
+        _remove_all([os.path.join(refs, str(p)) for p in holders])
+        try:
+            os.rmdir(refs)
+        except OSError:
+            pass
+
+
+def _release_chunks(refs, pid, paths):
+    """Drop the reference of process pid to the chunks at paths, removing them if no other live run holds one."""
+    _remove_all([os.path.join(refs, str(pid))])
+    try:
+        holders = [int(name) for name in os.listdir(refs) if name.isdigit()]
+    except FileNotFoundError:
+        holders = []
+    # references of runs that died without releasing them
+    _remove_all([os.path.join(refs, str(p)) for p in holders if not _process_alive(p)])
+    if not any(_process_alive(p) for p in holders):
+        _remove_all(paths)
+        try:
+            os.rmdir(refs)
+        except OSError:
+            pass
+
+
+class BlockShuffleSampler(Sampler):
+    """Shuffle batches while reading the dataset in contiguous blocks.
+
+    Every epoch the blocks of block_size consecutive samples are permuted and
+    taken buffer_blocks at a time. The samples of such a buffer are shuffled and
+    split into batches, so a batch is near-random but only touches blocks that
+    InputDataset reads whole and keeps in memory. Samples left over from a
+    buffer are carried over to the next one, so every epoch serves the same
+    number of batches as the unshuffled dataset. When streaming, all windows
+    of a batch are served in order.
+    With world_size processes all of them draw the same order (same seed) and
+    each serves every world_size-th batch from rank on, as many as the shards
+    of ShardedDataset hold.
+    Note that every DataLoader worker keeps its own blocks.
+    """
+    def __init__(self, dataset, seed=0, rank=0, world_size=1):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        block_size = self.dataset.block_size
+        buffer_blocks = self.dataset.shuffle['buffer_blocks']
+        batch_size = self.dataset.batch_size
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+
+        blocks = rng.permutation((self.dataset.limit + block_size - 1) // block_size)
+        carry = np.zeros(0, dtype=np.int64)
+        served, total = 0, len(self) // self.dataset.nr_windows * self.world_size
+        for i in range(0, len(blocks), buffer_blocks):
+            samples = np.concatenate([carry] + [np.arange(b * block_size, min((b + 1) * block_size, self.dataset.limit))
+                                                for b in blocks[i:i + buffer_blocks]])
+            rng.shuffle(samples)
+            nr_batches = len(samples) // batch_size
+            for b in range(nr_batches):
+                served += 1
+                if served > total:
+                    return
+                if (served - 1) % self.world_size != self.rank:
+                    continue
+                batch = tuple(samples[b * batch_size:(b + 1) * batch_size].tolist())
+                for window in range(self.dataset.nr_windows):
+                    yield batch, window
+            carry = samples[nr_batches * batch_size:]
+
+
+
+class ShardedDataset(Dataset):
+    """Dataset wrapper serving the batches of one of world_size processes.
+
+    Process rank gets the batches rank, rank + world_size, ... of dataset
+    (with all their windows when streaming). With drop_last every shard holds
+    the same number of batches, so all processes run the same number of steps,
+    otherwise the shards cover all batches and the first len % world_size
+    shards hold one more. The (samples, window) indices of a
+    BlockShuffleSampler are passed through, the sampler shards them itself.
+    Other attributes are those of the wrapped dataset.
+    """
+    def __init__(self, dataset, rank, world_size, drop_last=True):
+        self.dataset = dataset
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+
+    def __getattr__(self, name):
+        if name in ('dataset', 'rank', 'world_size', 'drop_last'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        nr_windows = self.dataset.nr_windows
+        nr_batches = len(self.dataset) // nr_windows
+        if not self.drop_last:
+            nr_batches += self.world_size - 1 - self.rank
+        return nr_batches // self.world_size * nr_windows
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.dataset[index]
+        batch, window = divmod(index, self.dataset.nr_windows)
+        return self.dataset[(batch * self.world_size + self.rank) * self.dataset.nr_windows + window]
+
+
+class Prefetcher(object):
+    """Prepare the next batches on a background thread while the current one computes.
+
+    Batches are taken from data_loader (HDF5 reads and decoding), pinned,
+    transferred to device and passed through prepare(data, index) on a daemon
+    thread, keeping up to depth batches ready (0: prepare them inline). On
+    CUDA the transfer and prepare run on a side stream, which the compute
+    stream waits for before a batch is handed out. Iterating yields the
+    outputs of prepare, index is the position of the batch in the epoch.
+
+    The seconds spent per phase in the last epoch are kept in timings: load,
+    transfer and prepare on the background thread, and wait for the time the
+    consumer was blocked on an empty queue.
+    """
+    def __init__(self, data_loader, prepare, device=None, depth=2):
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.prepare = prepare
+        self.device = device
+        self.depth = depth
+        self.timings = {}
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _batches(self, stop):
+        """Yield (batch, event) with the CUDA event marking the end of its preparation."""
+        cuda = self.device is not None and torch.device(self.device).type == 'cuda'
+        stream = torch.cuda.Stream() if cuda else None
+        batches = iter(self.data_loader)
+        index = 0
+        while not stop.is_set():
+            t = time.time()
+            try:
+                data = next(batches)
+            except StopIteration:
+                return
+            self.timings['load'] += time.time() - t
+
+            t = time.time()
+            if cuda:
+                data = [[x.pin_memory() for x in d] for d in data]
+                with torch.cuda.stream(stream):
+                    data = [[x.to(self.device, non_blocking=True) for x in d] for d in data]
+            elif self.device is not None:
+                data = [[x.to(self.device) for x in d] for d in data]
+            self.timings['transfer'] += time.time() - t
+
+            t = time.time()
+            if cuda:
+                with torch.cuda.stream(stream):
+                    batch = self.prepare(data, index)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+            else:
+                batch, event = self.prepare(data, index), None
+            self.timings['prepare'] += time.time() - t
+            index += 1
+            yield batch, event
+
+    def _produce(self, ready, stop):
+        try:
+            for item in self._batches(stop):
+                self._put(ready, stop, item)
+            self._put(ready, stop, None)
+        except BaseException as e:
+            self._put(ready, stop, e)
+
+    @staticmethod
+    def _put(ready, stop, item):
+        # give up once the consumer is gone, so the thread never blocks on a full queue
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        self.timings = {'load': 0., 'transfer': 0., 'prepare': 0., 'wait': 0.}
+        stop = threading.Event()
+        if self.depth == 0:
+            for batch, _ in self._batches(stop):
+                yield batch
+            return
+
+        ready = queue.Queue(maxsize=self.depth)
+        thread = threading.Thread(target=self._produce, args=(ready, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t = time.time()
+                item = ready.get()
+                self.timings['wait'] += time.time() - t
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    torch.cuda.current_stream().wait_event(event)
+                    for x in batch:
+                        if isinstance(x, torch.Tensor):
+                            x.record_stream(torch.cuda.current_stream())
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def pack_bits(bits):
+    """Pack a 0/1 tensor (..., W, H, C) into bytes of 8 pixels (..., nbytes), the inverse of unpack_bits."""
+    flat = bits.reshape(list(bits.size())[:-3] + [-1]).to(torch.uint8)
+    pad = -flat.size()[-1] % 8
+    if pad:
+        flat = torch.cat([flat, flat.new_zeros(list(flat.size())[:-1] + [pad])], -1)
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)
+    return (flat.view(list(flat.size())[:-1] + [-1, 8]) << shifts).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(packed, shape):
+    """Expand bytes of 8 pixels (..., nbytes) into a uint8 tensor (..., W, H, C)."""
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    bits = bits.view(list(packed.size())[:-1] + [-1])[..., :int(np.prod(shape))]
+    return bits.view(list(packed.size())[:-1] + list(shape))
+
+
 def collate(batch):
     '''data = [ [] for b in batch[0]]
     for b in batch:
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Data-parallel training over several processes with torch.distributed.
+
+Every process trains on its own shard of the batches (see ShardedDataset) and
+the gradients are averaged before every optimizer step, so all processes keep
+identical parameters. The gloo backend runs on CPU-only hosts. Processes are
+started with torchrun, which sets the environment read by init_distributed, e.g.
+
+    torchrun --nproc_per_node 4 nem.py with dataset.name=balls4mass64
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo', init_method='env://'):
+    """Join the process group described by the torchrun environment (RANK, WORLD_SIZE, ...).
+
+    :return: rank and world size, (0, 1) without a process group
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend, init_method=init_method)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def is_main_process():
+    """Whether this process logs and saves checkpoints (rank 0)."""
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def barrier():
+    if world_size() > 1:
+        dist.barrier()
+
+
+def all_reduce_mean(tensors):
+    """Average a list of tensors over all processes in place.
+
+    The tensors of each dtype are packed into one buffer, so there is one
+    collective per dtype instead of one per tensor.
+    """
+    n = world_size()
+    if n == 1:
+        return tensors
+    by_dtype = {}
+    for tensor in tensors:
+        by_dtype.setdefault(tensor.dtype, []).append(tensor)
+    for group in by_dtype.values():
+        flat = torch.cat([t.reshape(-1) for t in group])
+        dist.all_reduce(flat)
+        flat /= n
+        offset = 0
+        for t in group:
+            t.copy_(flat[offset:offset + t.numel()].view_as(t))
+            offset += t.numel()
+    return tensors
+
+
+def broadcast_module(module, src=0):
+    """Copy the parameters and buffers of module from process src to all others."""
+    if world_size() > 1:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def all_reduce_buffers(module):
+    """Average the floating point buffers of module (e.g. BatchNorm running statistics) over all processes."""
+    all_reduce_mean([b for b in module.buffers() if b.is_floating_point()])
+
+
+def reduce_log_dict(log_dict, weight=1., keys=('loss', 'ub_loss', 'r_loss', 'r_ub_loss', 'score')):
+    """Average the scalar entries keys of a log dict of run_epoch over all processes.
+
+    :param weight: weight of this process in the average, e.g. its number of
+        batches when the shards differ in size
+    """
+    if world_size() > 1:
+        values = [weight] + [weight * float(log_dict[key]) if weight else 0. for key in keys]
+        values = all_reduce_mean([torch.tensor(values, dtype=torch.float64)])[0]
+        log_dict.update(zip(keys, (values[1:] / values[0]).tolist()))
+    return log_dict
+
+
+class AllReduceOptimizer(object):
+    """Optimizer wrapper that averages the gradients over all processes before each step.
+
+    Buffers such as the BatchNorm running statistics drift apart between
+    processes, average them with all_reduce_buffers before evaluating or
+    saving. Other attributes are those of the wrapped optimizer.
+    """
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def __getattr__(self, name):
+        if name == 'optimizer':
+            raise AttributeError(name)
+        return getattr(self.optimizer, name)
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def step(self):
+        # every process runs the same graph, so the same parameters have gradients
+        grads = {id(p): p.grad for group in self.optimizer.param_groups for p in group['params'] if p.grad is not None}
+        all_reduce_mean(list(grads.values()))
+        self.optimizer.step()
@@ -6,7 +6,8 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # no INFO/WARN logs from Tensorflow
 
 import time
-import threading
+import functools
+import h5py
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
@@ -16,9 +17,13 @@ import utils
 from sacred import Experiment
 from sacred.utils import get_by_dotted_path
 from datasets import ds
-from datasets import InputDataset, collate
-from nem_model import nem, NEMCell, static_nem_iterations, get_loss_step_weights
-from network import net, R_NEM
+from datasets import InputDataset, CachedInputDataset, BlockShuffleSampler, ShardedDataset, Prefetcher, collate
+from distributed import (init_distributed, is_main_process, barrier, broadcast_module, all_reduce_buffers,
+                         reduce_log_dict, AllReduceOptimizer)
+from nem_model import (nem, NEMCell, static_nem_iterations, get_loss_step_weights, rollout_nem_iterations,
+                       binomial_cross_entropy_loss, compute_prior, sample_losses, batched_adjusted_rand_index)
+from network import net, R_NEM, optimize_for_inference
+from noise import Noise, NoisyDataset
 
 ex = Experiment("R-NEM", ingredients=[ds, nem, net])
 
@@ -27,8 +32,9 @@ ex = Experiment("R-NEM", ingredients=[ds, nem, net])
 @ex.config
 def cfg():
     noise = {
-        'noise_type': 'bitflip',                        # noise type
+        'noise_type': 'bitflip',                        # {bitflip, salt_pepper, masking, None}
         'prob': 0.2,                                    # probability of annihilating the pixel
+        'in_workers': False,                            # corrupt in the DataLoader workers instead of on device
     }
     training = {
         'optimizer': 'adam',                            # {adam, sgd, momentum, adadelta, adagrad, rmsprop}
@@ -38,6 +44,7 @@ def cfg():
         'max_patience': 10,                             # number of epochs to wait before early stopping
         'batch_size': 3,
         'num_workers' : 1,                              # number of data reading threads
+        'prefetch': 2,                                  # batches prepared ahead on a background thread (0: inline)
         'max_epoch': 500,
         'clip_gradients': None,                         # maximum norm of gradients
         'debug_samples': [3, 37, 54],                   # sample ids to generate plots for (None, int, list)
@@ -55,6 +62,7 @@ def cfg():
     dt = 10                                             # how many steps to include in the last loss
     log_dir = 'debug_out'                               # directory to dump logs and debug plots
     net_path = None                                     # path of to network file to initialize weights with
+    distributed_backend = 'gloo'                        # torch.distributed backend when started with torchrun
 
     # config to control run_from_file
     run_config = {
@@ -62,6 +70,8 @@ def cfg():
         'batch_size': 100,
         'rollout_steps': 10,
         'debug_samples': [0, 1, 2],                      # sample ids to generate plots for (None, int, list)
+        'output': None,                                 # HDF5 file written by infer/rollout (None: <log_dir>/<usage>_{inference,rollout}.h5)
+        'compression': 'gzip',                          # filter of the infer output {None, lzf, gzip}
     }
 
 
@@ -70,15 +80,21 @@ ex.add_named_config('no_collisions', {'record_relational_loss': None})
 
 
 @ex.capture
-def add_noise(data, noise):
-    noise_type = noise['noise_type']
-    if noise_type in ['None', 'none', None]:
-        return data
+def get_noise(noise, seed):
+    return Noise(noise['noise_type'], noise['prob'], seed)
 
-    n = torch.bernoulli(noise['prob']*torch.ones(data.size()))
-    p = 2*torch.mul(data,n)
-    corrupted = data + n - p  # hacky way of implementing (data XOR n)
-    return corrupted
+
+def prepare_batch(dataset, noise, data, index):
+    """Expand a loaded batch to float tensors and corrupt the features unless the workers did.
+
+    :return: features, corrupted features and the other datasets of the batch
+    """
+    if isinstance(dataset, NoisyDataset):
+        out = dataset.unpack(data[0][:-1])
+        return [out[0], dataset.corrupted(out[0], data[0][-1])] + out[1:]
+
+    out = dataset.unpack(data[0])
+    return [out[0], noise(out[0], [index])] + out[1:]
 
 
 @ex.capture(prefix='training')
@@ -148,27 +164,38 @@ def populate_debug_out(session, debug_graph, pipe_line, debug_samples, name):
     create_debug_plots(name, debug_out, idxs, debug_groups=debug_data.get('groups', None))
 
 
+def split_batch(data, out_list):
+    """Split a prepared batch into features, corrupted features, groups and collisions.
+
+    :param out_list: the datasets loaded for the batch, features first
+    :return: the four tensors, groups and collisions are None if they were not loaded
+    """
+    others = dict(zip(out_list[1:], data[2:]))
+    collisions = others.get('collisions', others.get('events'))
+    return data[0], data[1], others.get('groups'), collisions
+
+
 def run_epoch(nem_cell, optimizer, data_loader, train=True):
 
     losses, ub_losses, r_losses, r_ub_losses, others, others_ub, r_others, r_others_ub, ari_scores = [], [], [], [], [], [], [], [], []
+    nr_windows = data_loader.dataset.nr_windows
+    out_list = data_loader.dataset._out_list
+    state = None
+    compute = 0.
     # run through the epoch
     for progress, data in enumerate(data_loader):
-        # run batch
-        if torch.cuda.is_available():
-            features = data[0][0].cuda()
-            groups = data[0][1].cuda()
-            collisions= data[0][2].cuda()
-        else:
-            features = data[0][0]
-            groups = data[0][1]
-            collisions= data[0][2]
-
-        features_corrupted = add_noise(features)
+        features, features_corrupted, groups, collisions = split_batch(data, out_list)
+        # carry the EM state over consecutive windows of the same sequences
+        if progress % nr_windows == 0:
+            state = None
 
         t1 = time.time()
-        out = static_nem_iterations(nem_cell, features_corrupted, features, optimizer, train, groups, collisions=collisions, actions=None)
+        out = static_nem_iterations(nem_cell, features_corrupted, features, optimizer, train, groups, collisions=collisions, actions=None, hidden_state=state)
+        state = out[5]
         t2 = time.time() - t1
-        print(progress, t2)
+        compute += t2
+        if is_main_process():
+            print(progress, t2)
         # print("Finished static nem iteration")
         # total losses (and upperbound)
         losses.append(out[0].data.cpu().numpy())
@@ -187,7 +214,8 @@ def run_epoch(nem_cell, optimizer, data_loader, train=True):
         # r_others_ub.append(out[7].data.cpu().numpy())
 
         # ARI
-        ari_scores.append(out[4].data.cpu().numpy())
+        if groups is not None:
+            ari_scores.append(out[4].data.cpu().numpy())
         # ari_scores.append((0., 0., 0., 0.))
 
     # build log dict
@@ -200,33 +228,34 @@ def run_epoch(nem_cell, optimizer, data_loader, train=True):
         # 'others_ub': np.mean(others_ub, axis=0),
         # 'r_others': np.mean(r_others, axis=0),
         # 'r_others_ub': np.mean(r_others_ub, axis=0),
-        'score': np.mean(ari_scores, axis=0)
+        'score': np.mean(ari_scores, axis=0) if ari_scores else np.nan,     # nan without groups
         }
 
-    return log_dict
+    # timings are printed but not logged with the metrics
+    return log_dict, dict(data_loader.timings, compute=compute)
 
 def run_val_epoch(nem_cell, optimizer, data_loader):
 
     losses, ub_losses, r_losses, r_ub_losses, others, others_ub, r_others, r_others_ub, ari_scores = [], [], [], [], [], [], [], [], []
+    nr_windows = data_loader.dataset.nr_windows
+    out_list = data_loader.dataset._out_list
+    state = None
+    compute = 0.
     # run through the epoch
     with torch.no_grad():
         for progress, data in enumerate(data_loader):
-            # run batch
-            if torch.cuda.is_available():
-                features = data[0][0].cuda()
-                groups = data[0][1].cuda()
-                collisions= data[0][2].cuda()
-            else:
-                features = data[0][0]
-                groups = data[0][1]
-                collisions= data[0][2]
-
-            features_corrupted = add_noise(features)
+            features, features_corrupted, groups, collisions = split_batch(data, out_list)
+            # carry the EM state over consecutive windows of the same sequences
+            if progress % nr_windows == 0:
+                state = None
 
             t1 = time.time()
-            out = static_nem_iterations(nem_cell, features_corrupted, features, optimizer, False, groups, collisions=collisions, actions=None)
+            out = static_nem_iterations(nem_cell, features_corrupted, features, optimizer, False, groups, collisions=collisions, actions=None, hidden_state=state)
+            state = out[5]
             t2 = time.time() - t1
-            print(progress, t2)
+            compute += t2
+            if is_main_process():
+                print(progress, t2)
             # print("Finished static nem iteration")
             # total losses (and upperbound)
             losses.append(out[0].data.cpu().numpy())
@@ -245,7 +274,8 @@ def run_val_epoch(nem_cell, optimizer, data_loader):
             # r_others_ub.append(out[7].data.cpu().numpy())
 
             # ARI
-            ari_scores.append(out[4].data.cpu().numpy())
+            if groups is not None:
+                ari_scores.append(out[4].data.cpu().numpy())
             # ari_scores.append((0., 0., 0., 0.))
 
     # build log dict
@@ -258,10 +288,11 @@ def run_val_epoch(nem_cell, optimizer, data_loader):
         # 'others_ub': np.mean(others_ub, axis=0),
         # 'r_others': np.mean(r_others, axis=0),
         # 'r_others_ub': np.mean(r_others_ub, axis=0),
-        'score': np.mean(ari_scores, axis=0)
+        'score': np.mean(ari_scores, axis=0) if ari_scores else np.nan,     # nan without groups
         }
 
-    return log_dict
+    # timings are printed but not logged with the metrics
+    return log_dict, dict(data_loader.timings, compute=compute)
 
 
 @ex.capture
@@ -312,17 +343,221 @@ def print_log_dict(log_dict, usage, t, dt, s_loss_weights, dt_s_loss_weights):
     #       log_dict['r_others_ub'][-dt:, i].sum(0) / dt_s_loss_weights) for i in range(len(log_dict['r_others'][0]))])))
 
 
+def print_timings(timings):
+    print("    Data load: %.3fs, transfer: %.3fs, prepare: %.3fs, compute: %.3fs, waited for data: %.3fs" % tuple(timings[k] for k in ('load', 'transfer', 'prepare', 'compute', 'wait')))
+
+
+def rollout_batches(nem_cell, batches, rollout_steps, seed, start=0):
+    """Stream the rollout of every batch of a split.
+
+    :param batches: batches of features and corrupted features
+    :param seed: the initial state of batch i is drawn with seed + i
+    :param start: index of the first batch in the split
+    :return: generator of (batch index, t, features, pred, gamma, frame) for
+        every step t of every batch, with the true features (T, B, 1, W, H, C)
+        of the batch and the frame predicted for t + 1 (see rollout_nem_iterations)
+    """
+    for index, data in enumerate(batches, start):
+        features, features_corrupted = data[:2]
+        torch.manual_seed(seed + index)
+        for t, pred, gamma, frame in rollout_nem_iterations(nem_cell, features_corrupted, features, rollout_steps):
+            yield index, t, features, pred, gamma, frame
+
+
+@ex.command
+def rollout(run_config, nem, training, net_path, log_dir, seed):
+    """Evaluate the physics predictions of a saved network over the run_config usage split.
+
+    After a burn-in on the corrupted frames the network is fed its own
+    predictions for the last run_config.rollout_steps steps. Writes the
+    predictions (N, T, K, W, H, C) and gammas (N, T, K, W, H, 1) of every sample
+    and step to HDF5, with the binary cross entropy (N, T) of the frame
+    predicted at every step against the true next frame. The predicted frame
+    mixes the predictions with the gammas of the previous step, which have not
+    seen the frame. Prints the mean BCE per step. Reruns resume like infer.
+    """
+    assert net_path is not None, 'rollout needs a saved network, set net_path'
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    k, nr_steps, batch_size = nem['k'], nem['nr_steps'], run_config['batch_size']
+
+    # every batch is rolled out over its whole sequence of nr_steps
+    dataset = InputDataset(run_config['usage'], batch_size, ['features'], sequence_length=nr_steps + 1, stream=False)
+    nr_samples = len(dataset) * batch_size
+    W, H, C = dataset.frame_shape
+    shapes = {
+        'gamma': (nr_samples, nr_steps, k, W, H, 1),
+        'pred': (nr_samples, nr_steps, k, W, H, C),
+        'bce': (nr_samples, nr_steps),
+    }
+
+    path = run_config['output'] or os.path.join(log_dir, '{}_rollout.h5'.format(run_config['usage']))
+    attrs = {'net_path': os.path.abspath(net_path), 'dataset': os.path.abspath(dataset._path),
+             'usage': run_config['usage'], 'nr_samples': nr_samples, 'batch_size': batch_size,
+             'nr_steps': nr_steps, 'rollout_steps': run_config['rollout_steps'], 'k': k}
+    f, done, seed = open_inference_file(path, attrs, shapes, run_config['compression'], seed)
+    print('Writing {} batches to {}, {} done'.format(len(dataset), path, done))
+
+    noise = get_noise(seed=seed)
+    data_loader = DataLoader(dataset=dataset, batch_size=1, sampler=range(done, len(dataset)),
+                             num_workers=training['num_workers'], collate_fn=collate)
+    device = 'cuda' if torch.cuda.is_available() else None
+    prepare = lambda data, index: prepare_batch(dataset, noise, data, index + done)
+    batches = Prefetcher(data_loader, prepare, device, training['prefetch'])
+
+    nem_cell = NEMCell(R_NEM(k), input_shape=dataset.frame_shape, distribution=nem['pixel_dist'])
+    nem_cell.load_state_dict(torch.load(net_path))
+    nem_cell.eval()
+    optimize_for_inference(nem_cell.cell, inplace=True)
+
+    with f:
+        for index, t, features, pred, gamma, frame in rollout_batches(nem_cell, batches, run_config['rollout_steps'],
+                                                                       seed, done):
+            samples = slice(index * batch_size, (index + 1) * batch_size)
+            f['gamma'][samples, t] = gamma.cpu().numpy()
+            f['pred'][samples, t] = pred.cpu().numpy()
+            bce = binomial_cross_entropy_loss(frame, features[t+1]).view(batch_size, -1).sum(1)
+            f['bce'][samples, t] = bce.cpu().numpy()
+            if t == nr_steps - 1:
+                f.attrs['done'] = index + 1
+                f.flush()
+        losses = f['bce'][:].mean(0)
+
+    burn_in = nr_steps - run_config['rollout_steps']
+    print("{:>6} {:>10} {:>12}".format('step', 'phase', 'BCE'))
+    for t, loss in enumerate(losses):
+        print("{:>6} {:>10} {:>12.3f}".format(t + 1, 'burn-in' if t < burn_in else 'rollout', loss))
+    print('Saved to:', os.path.abspath(path))
+    return losses.tolist()
+
+
+def open_inference_file(path, attrs, shapes, compression, seed):
+    """Open the output of infer, resuming it if it was started with the same attrs and shapes.
+
+    Every dataset is chunked by sample and step, so a step of a batch is
+    written without holding the rest in memory.
+
+    :param attrs: settings the output depends on
+    :param shapes: shape of every dataset, sample and step axis first
+    :param seed: seed of the noise and initial states, a resumed file keeps its own
+    :return: the open h5py.File, the number of batches already written and the seed
+    """
+    if os.path.exists(path):
+        f = h5py.File(path, 'a')
+        if (all(f.attrs.get(key) == value for key, value in attrs.items()) and set(f) == set(shapes)
+                and all(f[name].shape == tuple(shape) for name, shape in shapes.items())):
+            return f, int(f.attrs['done']), int(f.attrs['seed'])
+        f.close()
+        print('Overwriting {} written with different settings'.format(path))
+
+    f = h5py.File(path, 'w')
+    f.attrs.update(attrs)
+    f.attrs['done'] = 0
+    f.attrs['seed'] = seed
+    for name, shape in shapes.items():
+        f.create_dataset(name, shape=shape, dtype=np.float32, chunks=(1, 1) + tuple(shape[2:]),
+                         compression=compression)
+    return f, 0, seed
+
+
+@ex.command
+def infer(run_config, nem, training, net_path, record_grouping_score, log_dir, seed):
+    """Run a saved network over the run_config usage split and write the results to HDF5.
+
+    Writes the gammas (N, T, K, W, H, 1), predictions (N, T, K, W, H, C), total
+    loss (N, T) and ARI score (N, T) of every sample and step, batch by batch.
+    After each batch its number is stored with the file, and a rerun with the
+    same settings continues after the last complete batch with the seed of the
+    first run.
+    """
+    assert net_path is not None, 'infer needs a saved network, set net_path'
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    k, nr_steps, batch_size = nem['k'], nem['nr_steps'], run_config['batch_size']
+
+    out_list = ['features', 'groups'] if record_grouping_score else ['features']
+    dataset = InputDataset(run_config['usage'], batch_size, out_list, sequence_length=nr_steps + 1)
+    nr_windows = dataset.nr_windows
+    nr_samples = len(dataset) // nr_windows * batch_size
+    W, H, C = dataset.frame_shape
+    shapes = {
+        'gamma': (nr_samples, nr_windows * nr_steps, k, W, H, 1),
+        'pred': (nr_samples, nr_windows * nr_steps, k, W, H, C),
+        'loss': (nr_samples, nr_windows * nr_steps),
+    }
+    if record_grouping_score:
+        shapes['score'] = (nr_samples, nr_windows * nr_steps)
+
+    path = run_config['output'] or os.path.join(log_dir, '{}_inference.h5'.format(run_config['usage']))
+    attrs = {'net_path': os.path.abspath(net_path), 'dataset': os.path.abspath(dataset._path),
+             'usage': run_config['usage'], 'nr_samples': nr_samples, 'nr_windows': nr_windows,
+             'batch_size': batch_size, 'nr_steps': nr_steps, 'k': k}
+    f, done, seed = open_inference_file(path, attrs, shapes, run_config['compression'], seed)
+    print('Writing {} batches to {}, {} done'.format(len(dataset) // nr_windows, path, done))
+
+    # skip the batches already written, the noise is keyed by the position in the full split
+    noise = get_noise(seed=seed)
+    data_loader = DataLoader(dataset=dataset, batch_size=1, sampler=range(done * nr_windows, len(dataset)),
+                             num_workers=training['num_workers'], collate_fn=collate)
+    device = 'cuda' if torch.cuda.is_available() else None
+    prepare = lambda data, index: prepare_batch(dataset, noise, data, index + done * nr_windows)
+    batches = Prefetcher(data_loader, prepare, device, training['prefetch'])
+
+    nem_cell = NEMCell(R_NEM(k), input_shape=dataset.frame_shape, distribution=nem['pixel_dist'])
+    nem_cell.load_state_dict(torch.load(net_path))
+    nem_cell.eval()
+    optimize_for_inference(nem_cell.cell, inplace=True)
+    prior = compute_prior(distribution=nem['pixel_dist'])
+
+    with f, torch.no_grad():
+        for index, data in enumerate(batches, done * nr_windows):
+            features, features_corrupted = data[:2]
+            batch, window = divmod(index, nr_windows)
+            samples = slice(batch * batch_size, (batch + 1) * batch_size)
+
+            # carry the EM state over consecutive windows, every batch starts from its own seed
+            if window == 0:
+                torch.manual_seed(seed + batch)
+                state = nem_cell.init_state(batch_size, k, dtype=torch.float32)
+
+            for t in range(nr_steps):
+                state, _ = nem_cell.forward((features_corrupted[t], features[t+1]), state)
+                _, pred, gamma = state
+                step = window * nr_steps + t
+                f['gamma'][samples, step] = gamma.cpu().numpy()
+                f['pred'][samples, step] = pred.cpu().numpy()
+                f['loss'][samples, step] = sample_losses(pred, gamma, features[t+1], prior,
+                                                           pixel_distribution=nem['pixel_dist']).cpu().numpy()
+                if record_grouping_score:
+                    labels = torch.argmax(gamma, 1)
+                    f['score'][samples, step] = batched_adjusted_rand_index(data[2][t], labels, k).cpu().numpy()
+
+            if window == nr_windows - 1:
+                f.attrs['done'] = batch + 1
+                f.flush()
+
+    print('Saved to:', os.path.abspath(path))
+    return path
+
+
 @ex.automain
-def run(record_grouping_score, record_relational_loss, feed_actions, net_path, training, validation, nem, dt, seed, log_dir, _run):
+def run(record_grouping_score, record_relational_loss, feed_actions, net_path, training, validation, nem, dataset, noise, dt, seed, log_dir, distributed_backend, _run):
     
     if torch.cuda.is_available():
         torch.set_default_tensor_type('torch.cuda.FloatTensor')
     save_epochs = training['save_epochs']
 
+    # data-parallel training when started with torchrun, only rank 0 reports to the observers
+    rank, world_size = init_distributed(distributed_backend)
+    main = is_main_process()
+    if not main:
+        _run.observers = []
+
     # clear debug dir
-    if log_dir and net_path is None:
+    if log_dir and net_path is None and main:
         utils.create_directory(log_dir)
         utils.delete_files(log_dir, recursive=True)
+    barrier()
 
     # prep weights for print out
     loss_step_weights = get_loss_step_weights()
@@ -336,56 +571,85 @@ def run(record_grouping_score, record_relational_loss, feed_actions, net_path, t
     out_list.append(record_relational_loss) if record_relational_loss else None
     out_list.append('actions') if feed_actions else None
 
-    train_dataset = InputDataset("training", training['batch_size'], out_list, sequence_length = nem['nr_steps'] + 1)
-    valid_dataset = InputDataset("validation", validation['batch_size'], out_list, sequence_length = nem['nr_steps'] + 1)
-    train_data_loader = DataLoader(dataset=train_dataset, batch_size=1,
+    Dataset = CachedInputDataset if dataset['cache'] else InputDataset
+    train_dataset = Dataset("training", training['batch_size'], out_list, sequence_length = nem['nr_steps'] + 1)
+    valid_dataset = Dataset("validation", validation['batch_size'], out_list, sequence_length = nem['nr_steps'] + 1)
+    if world_size > 1:
+        train_dataset = ShardedDataset(train_dataset, rank, world_size)
+        # validate on all batches, the shards are weighted by their size in reduce_log_dict
+        valid_dataset = ShardedDataset(valid_dataset, rank, world_size, drop_last=False)
+    train_sampler = BlockShuffleSampler(train_dataset, seed=seed, rank=rank, world_size=world_size) if train_dataset.shuffle else None
+
+    # validation noise does not change over epochs
+    train_noise, valid_noise = get_noise(seed=seed + rank), get_noise(seed=seed + rank)
+    if noise['in_workers']:
+        train_dataset, valid_dataset = NoisyDataset(train_dataset, train_noise), NoisyDataset(valid_dataset, valid_noise)
+    train_data_loader = DataLoader(dataset=train_dataset, batch_size=1, sampler=train_sampler,
                         shuffle=False, num_workers=training['num_workers'],
                         collate_fn=collate)
     valid_data_loader = DataLoader(dataset=valid_dataset, batch_size=1,
                         shuffle=False, num_workers=training['num_workers'],
                         collate_fn=collate)
-    
+
+    # load, transfer and corrupt the next batches while the current one computes
+    device = 'cuda' if torch.cuda.is_available() else None
+    train_batches = Prefetcher(train_data_loader, functools.partial(prepare_batch, train_dataset, train_noise),
+                               device, training['prefetch'])
+    valid_batches = Prefetcher(valid_data_loader, functools.partial(prepare_batch, valid_dataset, valid_noise),
+                               device, training['prefetch'])
+
     # Get dimensions
-    input_shape = train_dataset._data_in_file['features'].shape
-    W, H, C = list(input_shape)[-3:]
+    W, H, C = train_dataset.frame_shape
 
     inner_cell = R_NEM(nem['k'])
     nem_cell = NEMCell(inner_cell, input_shape=(W, H, C), distribution=nem['pixel_dist'])
     optimizer = set_up_optimizer(list(nem_cell.parameters())+list(inner_cell.parameters()))
+    if world_size > 1:
+        # start from the weights of rank 0 and average the gradients of all shards
+        broadcast_module(nem_cell)
+        optimizer = AllReduceOptimizer(optimizer)
 
     best_valid_loss = np.inf
     best_valid_epoch = 0
     for epoch in range(1, training['max_epoch'] + 1):
         # run train epoch
         t = time.time()
-        log_dict = run_epoch(nem_cell, optimizer, train_data_loader, train=True)
+        train_noise.epoch = epoch
+        log_dict, timings = run_epoch(nem_cell, optimizer, train_batches, train=True)
+        log_dict = reduce_log_dict(log_dict)
 
         # log all items in dict
         log_log_dict('training', log_dict)
 
         # produce print-out
-        print("\n" + 80 * "%" + "    EPOCH {}   ".format(epoch) + 80 * "%")
-        print_log_dict(log_dict, 'Train', t, dt, s_loss_weights, dt_s_loss_weights)
-
-        # run valid epoch
+        if main:
+            print("\n" + 80 * "%" + "    EPOCH {}   ".format(epoch) + 80 * "%")
+            print_log_dict(log_dict, 'Train', t, dt, s_loss_weights, dt_s_loss_weights)
+            print_timings(timings)
+
+        # run valid epoch with the BatchNorm statistics of all processes
+        if world_size > 1:
+            all_reduce_buffers(nem_cell)
         t = time.time()
-        log_dict = run_val_epoch(nem_cell, optimizer, valid_data_loader)
+        log_dict, timings = run_val_epoch(nem_cell, optimizer, valid_batches)
+        log_dict = reduce_log_dict(log_dict, weight=len(valid_batches))
 
         # add logs
         log_log_dict('validation', log_dict)
 
-        # produce plots
-        create_curve_plots('loss', {'training': get_logs('training.loss'),
-            'validation': get_logs('validation.loss')}, [0, 1000], [0, 200])
-        create_curve_plots('r_loss', {'training': get_logs('training.r_loss'),
-                                      'validation': get_logs('validation.r_loss')}, [0, 100], [0, 20])
+        # produce plots and print-out, all processes keep the logs to stop early together
+        if main:
+            create_curve_plots('loss', {'training': get_logs('training.loss'),
+                'validation': get_logs('validation.loss')}, [0, 1000], [0, 200])
+            create_curve_plots('r_loss', {'training': get_logs('training.r_loss'),
+                                          'validation': get_logs('validation.r_loss')}, [0, 100], [0, 20])
 
-        create_curve_plots('score', {'training': get_logs('training.score'),
-                                     'validation': get_logs('validation.score')}, [0, 1], None)
+            create_curve_plots('score', {'training': get_logs('training.score'),
+                                         'validation': get_logs('validation.score')}, [0, 1], None)
 
-        # produce print-out
-        print("\n")
-        print_log_dict(log_dict, 'Validation', t, dt, s_loss_weights, dt_s_loss_weights)
+            print("\n")
+            print_log_dict(log_dict, 'Validation', t, dt, s_loss_weights, dt_s_loss_weights)
+            print_timings(timings)
 
         if log_dict['loss'] < best_valid_loss:
             best_valid_loss = log_dict['loss']
@@ -402,10 +666,11 @@ def run(record_grouping_score, record_relational_loss, feed_actions, net_path, t
                           #float(np.sum(log_dict['r_others'][-dt:, 2]) / dt_s_loss_weights), \
                           #float(np.sum(log_dict['r_others_ub'][-dt:, 2]) / dt_s_loss_weights)
 
-            print("    Best validation loss improved to %.03f" % best_valid_loss)
-            torch.save(nem_cell.state_dict(), os.path.abspath(os.path.join(log_dir, 'best')))
-            print("    Saved to:", os.path.abspath(os.path.join(log_dir, 'best')))
-        if epoch in save_epochs:
+            if main:
+                print("    Best validation loss improved to %.03f" % best_valid_loss)
+                torch.save(nem_cell.state_dict(), os.path.abspath(os.path.join(log_dir, 'best')))
+                print("    Saved to:", os.path.abspath(os.path.join(log_dir, 'best')))
+        if epoch in save_epochs and main:
             torch.save(nem_cell.state_dict(), os.path.abspath(os.path.join(log_dir, 'epoch_{}'.format(epoch))))
             print("    Saved to:", os.path.abspath(os.path.join(log_dir, 'epoch_{}'.format(epoch))))
 
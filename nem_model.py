@@ -2,9 +2,12 @@
 # coding=utf-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import contextlib
+import functools
+import warnings
 import numpy as np
 import torch
-from network import net, R_NEM
+from network import net, R_NEM, checkpointed
 from sacred import Ingredient
 
 nem = Ingredient('nem', ingredients=[net])
@@ -15,6 +18,7 @@ def cfg():
     # loss
     loss_inter_weight = 1.0     # weight for the inter-cluster loss
     loss_step_weights = 'all'   # all, last, or list of weights
+    fused_loss = True           # compute gamma and all outer losses in one autograd node (see FusedEMLoss)
     pixel_prior = {
         'p': 0.0,               # probability of success for pixel prior Bernoulli
     }
@@ -24,13 +28,79 @@ def cfg():
     nr_steps = 30               # number of EM steps
     pred_init = 0.0             # initial prediction used to compute the input
     pixel_dist = 'bernoulli'
+    checkpoint_steps = None     # recompute activations in backward for segments of this many EM steps (None = keep all)
+    prune_mass = None           # in eval mode skip components with less mean gamma per pixel than this, e.g. 0.01
+    precision = 'float32'       # {float32, bfloat16}: run the input/output stacks in bf16 and keep the network's saved activations in bf16
+    compile_mode = None         # torch.compile the EM step and fused loss with this mode, e.g. default (None = eager)
+
+    # inference
+    early_exit = {
+        'criterion': 'max_change',  # {max_change, kl} between the gammas of consecutive steps of a sample
+        'tolerance': 1e-2,          # a sample has converged once the criterion falls below this
+        'min_steps': 2,             # steps every sample runs before it can exit
+    }
+    restarts = 4                # gamma initializations run side by side in the batch (see restart_nem_iterations)
+
+
+PRECISIONS = ('float32', 'bfloat16')
+
+
+def bf16_saved_activations():
+    """Context in which autograd saves float32 activations for backward as bfloat16.
+
+    Parameters are saved as they are. The activations are cast back to
+    float32 when backward uses them.
+    """
+    def pack(tensor):
+        if tensor.dtype != torch.float32 or (tensor.is_leaf and tensor.requires_grad):
+            return tensor, None
+        return tensor.to(torch.bfloat16), tensor.dtype
+
+    def unpack(packed):
+        tensor, dtype = packed
+        return tensor if dtype is None else tensor.to(dtype)
+
+    return torch.autograd.graph.saved_tensors_hooks(pack, unpack)
+
+
+# errors raised while tracing or compiling a graph, before any of it has run
+COMPILE_ERRORS = (torch._dynamo.exc.BackendCompilerFailed, torch._dynamo.exc.TorchRuntimeError,
+                  torch._dynamo.exc.InternalTorchDynamoError)
+
+
+def compile_with_fallback(fn, mode, name):
+    """torch.compile fn with mode, running fn eagerly from then on if compiling it fails.
+
+    Only compile errors fall back, errors raised while running the compiled
+    graph are raised as they are.
+    """
+    try:
+        compiled = torch.compile(fn, mode=mode)
+    except Exception as e:
+        warnings.warn('Compiling {} failed, running it eagerly: {}'.format(name, e))
+        return fn
+    failed = []
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not failed:
+            try:
+                return compiled(*args, **kwargs)
+            except COMPILE_ERRORS as e:
+                failed.append(e)
+                warnings.warn('Compiling {} failed, running it eagerly: {}'.format(name, e))
+        return fn(*args, **kwargs)
+    return wrapper
 
 
 class NEMCell(torch.nn.Module):
     """A RNNCell like implementation of N-EM."""
     @nem.capture
-    def __init__(self, cell, input_shape, distribution, pred_init):
+    def __init__(self, cell, input_shape, distribution, pred_init, prune_mass=None, precision='float32',
+                 compile_mode=None):
         super(NEMCell, self).__init__()
+        if precision not in PRECISIONS:
+            raise KeyError('Unknown precision "{}", use one of {}'.format(precision, PRECISIONS))
         self.cell = cell
         if not isinstance(input_shape, torch.Size):
             input_shape = torch.Size(input_shape)
@@ -38,6 +108,17 @@ class NEMCell(torch.nn.Module):
         self.gamma_shape = torch.Size(list(input_shape)[:-1] + [1])
         self.distribution = distribution
         self.pred_init = pred_init
+        self.prune_mass = prune_mass
+        self.precision = precision
+
+        # opt-in compiled EM step, falls back to eager if compiling fails
+        self.compile_mode = compile_mode
+        self._compiled = None
+        if compile_mode is not None:
+            self._compiled = {
+                'forward': compile_with_fallback(self._forward, compile_mode, 'NEMCell.forward'),
+                'predict': compile_with_fallback(self._predict, compile_mode, 'NEMCell.predict'),
+            }
 
     @property
     def state_size(self):
@@ -48,11 +129,12 @@ class NEMCell(torch.nn.Module):
         return self.cell.output_size, self.input_shape, self.gamma_shape
 
     def init_state(self, batch_size, K, dtype, gamma_init='gaussian'):
+        # the state stays in dtype under every precision, only the network runs in bf16
         # inner RNN hidden state init
-        h = self.cell.init_hidden(batch_size*K)
+        h = self.cell.init_hidden(batch_size*K).to(dtype)
 
         # initial prediction (B, K, W, H, C)
-        pred = torch.ones(torch.Size([batch_size, K] + list(self.input_shape))) * self.pred_init
+        pred = torch.full(torch.Size([batch_size, K] + list(self.input_shape)), self.pred_init, dtype=dtype)
 
         # initial gamma (B, K, W, H, 1)
         gamma_shape = list(self.gamma_shape)
@@ -66,7 +148,7 @@ class NEMCell(torch.nn.Module):
         if K == 1:
             gamma = torch.ones(gamma.size())
 
-        return h, pred, gamma
+        return h, pred, gamma.to(dtype)
 
     @staticmethod
     def delta_predictions(predictions, data):
@@ -94,18 +176,66 @@ class NEMCell(torch.nn.Module):
 
         return rnn_inputs * gamma  # implicitly broadcasts over C
 
-    def run_inner_rnn(self, masked_deltas, h_old):
+    @staticmethod
+    def nearest_neighbours(gamma, m):
+        """Select for each component the m components with the closest gamma centroids.
+        :param gamma: (B, K, W, H, 1)
+        :param m: number of neighbours
+
+        :return: neighbour ids (B, K, m)
+        """
+        gamma = gamma.detach()
+        W, H = list(gamma.size())[2:4]
+        mass = torch.sum(gamma, (2, 3, 4)) + 1e-6                               # (B, K)
+        xs = torch.arange(W, dtype=gamma.dtype, device=gamma.device).view(1, 1, W, 1, 1)
+        ys = torch.arange(H, dtype=gamma.dtype, device=gamma.device).view(1, 1, 1, H, 1)
+        centroids = torch.stack((torch.sum(gamma * xs, (2, 3, 4)) / mass,
+                                 torch.sum(gamma * ys, (2, 3, 4)) / mass), dim=2)  # (B, K, 2)
+
+        dist = torch.cdist(centroids, centroids)                                # (B, K, K)
+        K = dist.size()[1]
+        self_mask = torch.eye(K, dtype=torch.bool, device=dist.device)
+        dist = dist.masked_fill(self_mask, float('inf'))
+        _, neighbours = torch.topk(dist, m, dim=2, largest=False)
+        return neighbours
+
+    def alive_components(self, gamma):
+        """Components of every sample whose mean gamma per pixel is at least prune_mass.
+
+        The component with the most mass is always kept alive.
+
+        :param gamma: (B, K, W, H, 1)
+        :return: alive (B, K) bool, or None if no component is dead
+        """
+        gamma = gamma.detach()
+        mass = torch.mean(gamma.view(gamma.size()[0], gamma.size()[1], -1), 2)
+        alive = (mass >= self.prune_mass) | (mass == torch.max(mass, 1, keepdim=True)[0])
+        return None if bool(torch.all(alive)) else alive
+
+    def run_inner_rnn(self, masked_deltas, h_old, neighbours=None, alive=None):
         shape = masked_deltas.size()
         shape1 = list(shape)
         # print(masked_deltas.get_shape())
         batch_size = shape1[0]
         K = shape1[1]
-        M = np.prod(list(self.input_shape))
+        M = self.input_shape.numel()
         reshaped_masked_deltas = masked_deltas.view(batch_size * K, M)
 
-        preds, h_new = self.cell.forward(reshaped_masked_deltas, h_old)
-
-        return preds.view(shape), h_new
+        # the input and output stacks run in bf16 under the bfloat16 policy (R_NEM keeps the relational stacks in
+        # float32), their outputs return to float32. Only the saved activations of the network are kept in bf16,
+        # the E-step and losses save theirs in float32
+        bf16 = self.precision == 'bfloat16'
+        keep_bf16 = bf16 and self.training and torch.is_grad_enabled()
+        with torch.autocast(masked_deltas.device.type, dtype=torch.bfloat16, enabled=bf16), \
+                bf16_saved_activations() if keep_bf16 else contextlib.nullcontext():
+            if neighbours is None and alive is None:
+                preds, h_new = self.cell.forward(reshaped_masked_deltas, h_old)
+            elif alive is None:
+                preds, h_new = self.cell.forward(reshaped_masked_deltas, h_old, neighbours=neighbours)
+            else:
+                preds, h_new = self.cell.forward(reshaped_masked_deltas, h_old, neighbours=neighbours, alive=alive)
+
+        return preds.view(shape).to(masked_deltas.dtype), h_new.to(h_old.dtype)
 
     def compute_em_probabilities(self, predictions, data, epsilon=1e-6):
         """Compute pixelwise loss of predictions (wrt. the data).
@@ -138,9 +268,18 @@ class NEMCell(torch.nn.Module):
 
         return gamma
 
-    def forward(self, inputs, state, scope=None):
-        # unpack
-        input_data, target_data = inputs
+    def predict(self, input_data, state):
+        """Run the inner RNN on the gamma-masked deltas of the previous predictions.
+
+        :param input_data: (B, 1, W, H, C)
+        :param state: (h, preds, gamma) of the previous step
+        :return: new hidden state and predictions (B, K, W, H, C)
+        """
+        if self._compiled is not None:
+            return self._compiled['predict'](input_data, state)
+        return self._predict(input_data, state)
+
+    def _predict(self, input_data, state):
         h_old, preds_old, gamma_old = state
 
         # compute differences between prediction and input
@@ -149,8 +288,33 @@ class NEMCell(torch.nn.Module):
         # mask with gamma
         masked_deltas = self.mask_rnn_inputs(deltas, gamma_old)
 
+        # restrict interactions to the closest components (sparse R-NEM)
+        neighbours = None
+        if getattr(self.cell, 'neighbours', None) is not None:
+            neighbours = self.nearest_neighbours(gamma_old, self.cell.neighbours)
+
+        # at inference skip components without gamma mass, which keep their predictions
+        alive = None
+        if self.prune_mass and not self.training:
+            alive = self.alive_components(gamma_old)
+
+        # compute new predictions
+        preds, h_new = self.run_inner_rnn(masked_deltas, h_old, neighbours, alive)
+        if alive is not None:
+            preds = torch.where(alive.view(list(alive.size()) + [1] * (preds.dim() - 2)), preds, preds_old)
+        return h_new, preds
+
+    def forward(self, inputs, state, scope=None):
+        if self._compiled is not None:
+            return self._compiled['forward'](inputs, state)
+        return self._forward(inputs, state)
+
+    def _forward(self, inputs, state):
+        # unpack
+        input_data, target_data = inputs
+
         # compute new predictions
-        preds, h_new = self.run_inner_rnn(masked_deltas, h_old)
+        h_new, preds = self._predict(input_data, state)
 
         # compute the new gammas
         gamma = self.e_step(preds, target_data)
@@ -239,6 +403,165 @@ def compute_outer_ub_loss(pred, target, prior, pixel_distribution, collision, lo
     return total_ub_loss, r_total_ub_loss
 
 
+def _bce_grad(y, t):
+    """Derivative of binomial_cross_entropy_loss wrt. y."""
+    clipped_y = torch.clamp(y, min=1e-6, max=1.-1.e-6)
+    inside = (y >= 1e-6) & (y <= 1.-1.e-6)
+    return torch.where(inside, (1. - t) / (1. - clipped_y) - t / clipped_y, torch.zeros_like(y))
+
+
+def _kl_bernoulli_grad(p1, p2):
+    """Derivative of kl_loss_bernoulli wrt. p2."""
+    def ratio_grad(p, q):
+        # d/dq of p * log(clamp(p / clamp(q)))
+        clipped_q = torch.clamp(q, min=1e-6, max=1e6)
+        ratio = p / clipped_q
+        inside = (q >= 1e-6) & (q <= 1e6) & (ratio >= 1e-6) & (ratio <= 1e6)
+        return torch.where(inside, -p / clipped_q, torch.zeros_like(q))
+    return ratio_grad(p1, p2) - ratio_grad(1 - p1, 1 - p2)
+
+
+def _fused_em_forward(pred, target, prior, collision, loss_inter_weight, epsilon):
+    """Forward of FusedEMLoss, returns gamma, the four losses and the best component per pixel."""
+    batch_size = pred.size()[0]
+
+    # E-step
+    probs = torch.sum(target * pred + (1 - target) * (1 - pred), 4, keepdim=True) + epsilon
+    gamma = probs / torch.sum(probs, 1, keepdim=True)
+    del probs
+
+    # gamma weighted losses
+    intra = binomial_cross_entropy_loss(pred, target) * gamma
+    inter = kl_loss_bernoulli(prior, pred) * (1. - gamma)
+    loss = intra + loss_inter_weight * inter
+    del intra, inter
+    total_loss = torch.sum(loss) / batch_size
+    r_total_loss = torch.sum(collision * loss) / batch_size
+    del loss
+
+    # upper bound with the best component for every pixel
+    max_pred, argmax = torch.max(pred, 1, keepdim=True)
+    ub_loss = binomial_cross_entropy_loss(max_pred, target) + loss_inter_weight * kl_loss_bernoulli(prior, max_pred)
+    total_ub_loss = torch.sum(ub_loss) / batch_size
+    r_total_ub_loss = torch.sum(collision * ub_loss) / batch_size
+    del ub_loss, max_pred
+
+    return gamma, total_loss, total_ub_loss, r_total_loss, r_total_ub_loss, argmax
+
+
+def _fused_em_backward(pred, target, prior, collision, gamma, argmax, w, grad_total, grad_ub, grad_r_total, grad_r_ub):
+    """Backward of FusedEMLoss, returns the gradient wrt. pred."""
+    batch_size = pred.size()[0]
+
+    # gradient of the gamma weighted losses
+    scale = (grad_total + grad_r_total * collision) / batch_size
+    grad_pred = (_bce_grad(pred, target) * gamma + w * _kl_bernoulli_grad(prior, pred) * (1. - gamma)) * scale
+
+    # the upper bound only reaches the best component
+    max_pred = torch.gather(pred, 1, argmax)
+    scale = (grad_ub + grad_r_ub * collision) / batch_size
+    grad_max = (_bce_grad(max_pred, target) + w * _kl_bernoulli_grad(prior, max_pred)) * scale
+    return grad_pred.scatter_add(1, argmax, grad_max)
+
+
+# compiled versions of the loss functions per (function, mode), see compile_with_fallback
+_compiled_losses = {}
+
+
+def _loss_function(fn, compile_mode):
+    if compile_mode is None:
+        return fn
+    key = (fn.__name__, compile_mode)
+    if key not in _compiled_losses:
+        _compiled_losses[key] = compile_with_fallback(fn, compile_mode, fn.__name__)
+    return _compiled_losses[key]
+
+
+class FusedEMLoss(torch.autograd.Function):
+    """E-step and all outer losses of an EM step as a single autograd node.
+
+    Computes the same values as e_step, compute_outer_loss and
+    compute_outer_ub_loss, but keeps only its inputs and the new gamma for
+    backward and recomputes the few elementwise terms of the gradient there,
+    instead of holding on to the clamps, logs and ratios of every loss. The
+    gradient only flows to the predictions: gamma is detached in the losses
+    and returned as non-differentiable. With a compile_mode the forward and
+    backward computations are compiled.
+    """
+    @staticmethod
+    def forward(ctx, pred, target, prior, collision, loss_inter_weight, epsilon, compile_mode=None):
+        out = _loss_function(_fused_em_forward, compile_mode)(pred, target, prior, collision, loss_inter_weight, epsilon)
+        gamma, argmax = out[0], out[5]
+
+        ctx.save_for_backward(pred, target, prior, collision, gamma, argmax)
+        ctx.loss_inter_weight = loss_inter_weight
+        ctx.compile_mode = compile_mode
+        ctx.mark_non_differentiable(gamma)
+        return out[:5]
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_gamma, grad_total, grad_ub, grad_r_total, grad_r_ub):
+        pred, target, prior, collision, gamma, argmax = ctx.saved_tensors
+        grad_pred = _loss_function(_fused_em_backward, ctx.compile_mode)(
+            pred, target, prior, collision, gamma, argmax, ctx.loss_inter_weight,
+            grad_total, grad_ub, grad_r_total, grad_r_ub)
+        return grad_pred, None, None, None, None, None, None
+
+
+@nem.capture
+def fused_em_loss(pred, target, prior, pixel_distribution, collision, loss_inter_weight, epsilon=1e-6,
+                  compile_mode=None):
+    """Compute the new gamma and the total, upper bound, relational and relational upper bound loss.
+
+    :param pred: (B, K, W, H, C)
+    :param target: (B, 1, W, H, C)
+    :param collision: (B, 1, W, H, C) or (1, 1, 1, 1, 1)
+    :return: gamma (B, K, W, H, 1) and the four losses
+    """
+    if pixel_distribution != 'bernoulli':
+        raise KeyError('Unknown pixel_distribution: "{}"'.format(pixel_distribution))
+    prior = prior.to(pred)
+    collision = collision.to(pred)
+    return FusedEMLoss.apply(pred, target, prior, collision, loss_inter_weight, epsilon, compile_mode)
+
+
+@nem.capture
+def sample_losses(pred, gamma, target, prior, pixel_distribution, loss_inter_weight):
+    """Total loss of every sample as in compute_outer_loss, without averaging over the batch.
+
+    :return: losses (B,)
+    """
+    if pixel_distribution == 'bernoulli':
+        intra_loss = binomial_cross_entropy_loss(pred, target)
+        inter_loss = kl_loss_bernoulli(prior, pred)
+    else:
+        raise KeyError('Unknown pixel_distribution: "{}"'.format(pixel_distribution))
+
+    gamma = gamma.detach()
+    loss = intra_loss * gamma + loss_inter_weight * inter_loss * (1. - gamma)
+    return torch.sum(loss.view(loss.size()[0], -1), 1)
+
+
+def gamma_change(gamma, gamma_old, criterion):
+    """Per sample change between the gammas of consecutive steps.
+
+    :param gamma: (B, K, W, H, 1)
+    :param gamma_old: (B, K, W, H, 1)
+    :param criterion: max_change (largest absolute change of any gamma) or
+        kl (mean over pixels of KL(gamma || gamma_old) over the components)
+    :return: change (B,)
+    """
+    batch_size = gamma.size()[0]
+    if criterion == 'max_change':
+        return torch.max(torch.abs(gamma - gamma_old).view(batch_size, -1), 1)[0]
+    elif criterion == 'kl':
+        kl = torch.sum(gamma * (torch.log(gamma + 1e-6) - torch.log(gamma_old + 1e-6)), 1)
+        return torch.mean(kl.view(batch_size, -1), 1)
+    else:
+        raise KeyError('Unknown convergence criterion: "{}"'.format(criterion))
+
+
 @nem.capture
 def get_loss_step_weights(nr_steps, loss_step_weights):
     if loss_step_weights == 'all':
@@ -262,56 +585,63 @@ def adjusted_rand_index(groups, gammas):
         gammas: shape=(B, K, W, H, 1)
             These are the gammas as predicted by the network
     """
-    # reshape gammas and convert to one-hot
     yshape = list(gammas.size())
-    gammas = gammas.view(yshape[0], yshape[1], yshape[2] * yshape[3] * yshape[4])
-    tensor = torch.LongTensor
-    if torch.cuda.is_available():
-        tensor = torch.cuda.LongTensor
-    Y = tensor(yshape[0], yshape[1], yshape[2] * yshape[3] * yshape[4]).zero_()
-    Y.scatter_(1,torch.argmax(gammas,dim=1,keepdim=True), 1)
-    # reshape masks
-    gshape = list(groups.size())
-    groups = groups.view(gshape[0], 1, gshape[2] * gshape[3] * gshape[4])
-    G = tensor(gshape[0], torch.max(groups).int()+1, gshape[2] * gshape[3] * gshape[4]).zero_()
-    G.scatter_(1,groups.long(), 1)
-    # now Y and G both have dim (B*T, K, N) where N=W*H*C
-    # mask entries with group 0
-    M = torch.ge(groups, 0.5).float()
-    n = torch.sum(torch.sum(M, 2), 1)
-    DM = G.float() * M
-    YM = Y.float() * M
-    # contingency table for overlap between G and Y
-    nij = torch.einsum('bij,bkj->bki', (YM, DM))
-    a = torch.sum(nij, dim=1)
-    b = torch.sum(nij, dim=2)
-    # rand index
-    rindex = torch.sum(torch.sum(nij * (nij-1), 2),1).float()
-    aindex = torch.sum(a * (a-1), dim=1).float()
-    bindex = torch.sum(b * (b-1), dim=1).float()
-    expected_rindex = aindex * bindex / (n*(n-1) + 1e-6)
-    max_rindex = (aindex + bindex) / 2
-    ARI = (rindex - expected_rindex)/torch.clamp(max_rindex - expected_rindex, 1e-6, 1e6)
-    mean_ARI = torch.mean(ARI)
-    del yshape, Y, gshape, G, M, n, DM, YM, nij, a, b, rindex, bindex, expected_rindex, max_rindex, ARI
-    return mean_ARI
+    labels = torch.argmax(gammas.view(yshape[0], yshape[1], -1), dim=1)
+    return torch.mean(batched_adjusted_rand_index(groups, labels, yshape[1]))
 
-@nem.capture
-def static_nem_iterations(nem_cell, input_data, target_data, optimizer, train, groups, k, pixel_dist, collisions=None, actions=None):
 
-    # compute prior
-    prior = compute_prior(distribution=pixel_dist)
+def batched_adjusted_rand_index(groups, labels, k):
+    """ARI of every sample from contingency tables counted with bincount.
 
-    # get state initializer
-    hidden_state = nem_cell.init_state(list(input_data.size())[1], k, dtype=torch.float32)
+    Pixels of group 0 are ignored. Needs O(S*K*G) memory for the tables
+    instead of one-hot (S, K, N) and (S, G, N) tensors.
 
-    # build static iterations
-    outputs = [hidden_state]
-    total_losses, total_ub_losses, r_total_losses, r_total_ub_losses, other_losses, other_ub_losses, r_other_losses, r_other_ub_losses, ari_scores = [], [], [], [], [], [], [], [], []
-    loss_step_weights = get_loss_step_weights()
+    :param groups: (S, ...) true groups of the N pixels of every sample
+    :param labels: (S, ...) predicted component ids in [0, k) of the same pixels
+    :param k: number of components
+    :return: ARI scores (S,)
+    """
+    with torch.no_grad():
+        nr_samples = labels.size()[0]
+        groups = groups.reshape(nr_samples, -1).long()
+        labels = labels.reshape(nr_samples, -1).long()
+        nr_groups = int(torch.max(groups)) + 1
+
+        # contingency table (S, K, G) of the pixels that belong to a group
+        mask = groups > 0
+        samples = torch.arange(nr_samples, device=labels.device).view(-1, 1).expand_as(labels)
+        index = (samples * k + labels) * nr_groups + groups
+        nij = torch.bincount(index[mask], minlength=nr_samples * k * nr_groups)
+        nij = nij.view(nr_samples, k, nr_groups).float()
+
+        n = torch.sum(mask, 1).float()
+        a = torch.sum(nij, dim=2)
+        b = torch.sum(nij, dim=1)
+        # rand index
+        rindex = torch.sum(nij * (nij - 1), (1, 2))
+        aindex = torch.sum(a * (a - 1), dim=1)
+        bindex = torch.sum(b * (b - 1), dim=1)
+        expected_rindex = aindex * bindex / (n*(n-1) + 1e-6)
+        max_rindex = (aindex + bindex) / 2
+        return (rindex - expected_rindex) / torch.clamp(max_rindex - expected_rindex, 1e-6, 1e6)
+
+
+def run_em_steps(nem_cell, t0, t1, h, pred, gamma, input_data, target_data, prior, pixel_dist,
+                 collisions=None, actions=None, fused_loss=False, scored_steps=None):
+    """Run EM steps t0 <= t < t1 and compute the losses of the scored steps.
+
+    Steps that are not scored only run the cell and the E-step.
+
+    :param scored_steps: steps to compute losses and labels for (None: all)
+    :return: final (h, pred, gamma), losses (n, 4) holding the total, upper bound,
+        relational and relational upper bound loss of each of the n scored steps in
+        [t0, t1), and the component with the highest gamma per pixel (n, B, W*H)
+    """
+    hidden_state = (h, pred, gamma)
+    losses, labels = [], []
+    for t in range(t0, t1):
+        scored = scored_steps is None or t in scored_steps
 
-    for t, loss_weight in enumerate(loss_step_weights):
-        # varscope.reuse_variables() if t > 0 else None
         # compute inputs
         inputs = (input_data[t], target_data[t+1])
 
@@ -321,56 +651,254 @@ def static_nem_iterations(nem_cell, input_data, target_data, optimizer, train, g
             h_old = {'state': h_old, 'action': actions[t]}
             hidden_state = (h_old, preds_old, gamma_old)
 
-        # run hidden cell
-        hidden_state, output = nem_cell.forward(inputs, hidden_state)
-        theta, pred, gamma = output
+        if not scored:
+            # run hidden cell and E-step only
+            hidden_state, _ = nem_cell.forward(inputs, hidden_state)
+            continue
 
         # set collision
         collision = torch.zeros(1, 1, 1, 1, 1) if collisions is None else collisions[t]
 
-        # compute nem losses
-        total_loss, r_total_loss = compute_outer_loss(pred, gamma, target_data[t+1], prior, pixel_distribution=pixel_dist, collision=collision)
-
-        # compute estimated loss upper bound (which doesn't use E-step)
-        total_ub_loss, r_total_ub_loss = compute_outer_ub_loss(pred, target_data[t+1], prior, pixel_distribution=pixel_dist, collision=collision)
+        if fused_loss:
+            # run hidden cell, E-step and all losses in one go
+            theta, pred = nem_cell.predict(input_data[t], hidden_state)
+            gamma, total_loss, total_ub_loss, r_total_loss, r_total_ub_loss = fused_em_loss(
+                pred, target_data[t+1], prior, pixel_distribution=pixel_dist, collision=collision,
+                compile_mode=nem_cell.compile_mode)
+            hidden_state = (theta, pred, gamma)
+        else:
+            # run hidden cell
+            hidden_state, output = nem_cell.forward(inputs, hidden_state)
+            theta, pred, gamma = output
 
-        total_losses.append(loss_weight * total_loss)
-        total_ub_losses.append(loss_weight * total_ub_loss)
+            # compute nem losses
+            total_loss, r_total_loss = compute_outer_loss(pred, gamma, target_data[t+1], prior, pixel_distribution=pixel_dist, collision=collision)
 
-        r_total_losses.append(loss_weight * r_total_loss)
-        r_total_ub_losses.append(loss_weight * r_total_ub_loss)
+            # compute estimated loss upper bound (which doesn't use E-step)
+            total_ub_loss, r_total_ub_loss = compute_outer_ub_loss(pred, target_data[t+1], prior, pixel_distribution=pixel_dist, collision=collision)
 
-        ari_scores.append(adjusted_rand_index(groups[t], gamma))
+        losses.append(torch.stack([total_loss, total_ub_loss, r_total_loss, r_total_ub_loss]))
+        labels.append(torch.argmax(gamma.detach(), 1).view(gamma.size()[0], -1))
         del theta, pred, gamma
 
-        '''other_losses.append(torch.stack([total_loss, intra_loss, inter_loss]))
-        other_ub_losses.append(torch.stack([total_ub_loss, intra_ub_loss, inter_ub_loss]))
-
-        r_other_losses.append(torch.stack([r_total_loss, r_intra_loss, r_inter_loss]))
-        r_other_ub_losses.append(torch.stack([r_total_ub_loss, r_intra_ub_loss, r_inter_ub_loss]))
-
-        outputs.append(output)'''
-
-    # collect outputs
-    # thetas, preds, gammas = zip(*outputs)
-    # thetas = torch.stack(thetas)               # (T, 1, B*K, M)
-    # preds = torch.stack(preds)                 # (T, B, K, W, H, C)
-    # gammas = torch.stack(gammas)               # (T, B, K, W, H, C)
-    # other_losses = torch.stack(other_losses)   # (T, 3)
-    # other_ub_losses = torch.stack(other_ub_losses)   # (T, 3)
-    # r_other_losses = torch.stack(r_other_losses)
-    # r_other_ub_losses = torch.stack(r_other_ub_losses)
-    total_loss = torch.sum(torch.stack(total_losses)) / np.sum(loss_step_weights)
-    total_ub_loss = torch.sum(torch.stack(total_ub_losses)) / np.sum(loss_step_weights)
-    r_total_loss = torch.sum(torch.stack(r_total_losses)) / np.sum(loss_step_weights)
-    r_total_ub_loss = torch.sum(torch.stack(r_total_ub_losses)) / np.sum(loss_step_weights)
-    total_ari_score = torch.sum(torch.stack(ari_scores)) / np.sum(loss_step_weights)
+    h, pred, gamma = hidden_state
+    if not losses:
+        return h, pred, gamma, pred.new_zeros((0, 4)), pred.new_zeros((0, gamma.size()[0], gamma[0, 0].numel()), dtype=torch.long)
+    return h, pred, gamma, torch.stack(losses), torch.stack(labels)
+
+
+@nem.capture
+def static_nem_iterations(nem_cell, input_data, target_data, optimizer, train, groups, k, pixel_dist, checkpoint_steps,
+                          fused_loss, collisions=None, actions=None, hidden_state=None):
+    """Run all EM steps on a batch and (if train) update the parameters.
+
+    Losses and ARI scores are only computed for the steps with a non-zero loss
+    step weight, and the ARI score is weighted like the losses.
+
+    :param groups: (T, B, 1, W, H, 1) or None to skip the ARI score
+    :param hidden_state: (h, pred, gamma) to continue from, e.g. the final state of
+        the previous window of the same sequences. A fresh state is drawn if None.
+    :return: total, upper bound, relational and relational upper bound loss, ARI score
+        and the final (h, pred, gamma), detached from the graph.
+    """
+
+    # compute prior
+    prior = compute_prior(distribution=pixel_dist)
+
+    # get state initializer
+    if hidden_state is None:
+        hidden_state = nem_cell.init_state(list(input_data.size())[1], k, dtype=torch.float32)
+
+    # build static iterations, optionally in checkpointed segments of EM steps
+    loss_step_weights = get_loss_step_weights()
+    nr_steps = len(loss_step_weights)
+    checkpoint = checkpoint_steps is not None and train and torch.is_grad_enabled()
+    segment = checkpoint_steps if checkpoint else nr_steps
+
+    # losses and scores are only computed for steps that are weighted
+    scored_steps = [t for t, w in enumerate(loss_step_weights) if w != 0]
+    weights = [loss_step_weights[t] for t in scored_steps]
+
+    losses, labels = [], []
+    for t0 in range(0, nr_steps, segment):
+        t1 = min(t0 + segment, nr_steps)
+        run_segment = functools.partial(run_em_steps, nem_cell, t0, t1, input_data=input_data, target_data=target_data,
+                                        prior=prior, pixel_dist=pixel_dist, collisions=collisions,
+                                        actions=actions, fused_loss=fused_loss, scored_steps=scored_steps)
+        if checkpoint:
+            out = checkpointed(nem_cell, run_segment, *hidden_state)
+        else:
+            out = run_segment(*hidden_state)
+        hidden_state = out[:3]
+        losses.append(out[3])
+        labels.append(out[4])
+
+    # collect the weighted losses (n, 4) and scores (n,) of the scored steps
+    weights = losses[0].new_tensor(weights)
+    losses = torch.cat(losses) * weights.view(-1, 1)
+    total_loss, total_ub_loss, r_total_loss, r_total_ub_loss = torch.unbind(torch.sum(losses, 0) / np.sum(loss_step_weights))
+
+    # ARI of all scored steps and samples at once (n*B,)
+    if groups is not None and scored_steps:
+        labels = torch.cat(labels)
+        labels = labels.view(-1, labels.size()[2])
+        step_groups = groups[torch.tensor(scored_steps, device=groups.device)].view(labels.size()[0], -1)
+        ari_scores = batched_adjusted_rand_index(step_groups, labels, hidden_state[2].size()[1])
+        ari_scores = torch.mean(ari_scores.view(len(scored_steps), -1), 1)
+    else:
+        ari_scores = torch.zeros_like(weights)
+    total_ari_score = torch.sum(ari_scores * weights) / np.sum(loss_step_weights)
 
     if train:
         optimizer.zero_grad()
         total_loss.backward()
         optimizer.step()
 
-    return total_loss, total_ub_loss, r_total_loss, r_total_ub_loss, total_ari_score
-            # other_losses, other_ub_losses, r_other_losses, r_other_ub_losses
+    # truncate backpropagation at the end of the window
+    final_state = tuple(x.detach() for x in hidden_state)
+
+    return total_loss, total_ub_loss, r_total_loss, r_total_ub_loss, total_ari_score, final_state
+
+
+@nem.capture
+def early_exit_nem_iterations(nem_cell, input_data, target_data, k, nr_steps, pixel_dist, early_exit,
+                              hidden_state=None):
+    """Run EM steps for inference until the gammas of every sample have converged.
+
+    A sample exits once its gammas change by less than early_exit['tolerance']
+    between consecutive steps (after at least early_exit['min_steps']) and is
+    removed from the active batch, so later steps only compute the samples
+    that are still changing. Samples are processed independently, so the cell
+    has to be in eval mode.
+
+    :param hidden_state: (h, pred, gamma) to start from, drawn fresh if None
+    :return: the (h, pred, gamma) of every sample at its exit, the number of
+        steps every sample ran (B,) and its total loss at the exit step (B,)
+    """
+    assert not nem_cell.training, 'early exit needs the batch independent eval mode'
+    prior = compute_prior(distribution=pixel_dist)
+    batch_size = list(input_data.size())[1]
+
+    with torch.no_grad():
+        if hidden_state is None:
+            hidden_state = nem_cell.init_state(batch_size, k, dtype=torch.float32)
+        h, pred, gamma = hidden_state
+        h = h.view(batch_size, k, -1)
+
+        # outputs of every sample, filled in as samples exit
+        final_h, final_pred, final_gamma = h.clone(), pred.clone(), gamma.clone()
+        steps = torch.zeros(batch_size, dtype=torch.long, device=pred.device)
+        losses = pred.new_zeros(batch_size)
+
+        active = torch.arange(batch_size, device=pred.device)
+        for t in range(nr_steps):
+            inputs = (input_data[t][active], target_data[t+1][active])
+            state = (h.view(len(active) * k, -1), pred, gamma)
+            (h, pred, new_gamma), _ = nem_cell.forward(inputs, state)
+            h = h.view(len(active), k, -1)
+
+            if t + 1 == nr_steps:
+                done = torch.ones_like(active, dtype=torch.bool)
+            elif t + 1 >= early_exit['min_steps']:
+                done = gamma_change(new_gamma, gamma, early_exit['criterion']) < early_exit['tolerance']
+            else:
+                done = torch.zeros_like(active, dtype=torch.bool)
+            gamma = new_gamma
+            if not torch.any(done):
+                continue
+
+            # store the exiting samples and shrink the active batch
+            exits = active[done]
+            final_h[exits], final_pred[exits], final_gamma[exits] = h[done], pred[done], gamma[done]
+            steps[exits] = t + 1
+            losses[exits] = sample_losses(pred[done], gamma[done], target_data[t+1][exits], prior,
+                                          pixel_distribution=pixel_dist)
+            keep = ~done
+            active, h, pred, gamma = active[keep], h[keep], pred[keep], gamma[keep]
+            if len(active) == 0:
+                break
+
+    return (final_h.view(batch_size * k, -1), final_pred, final_gamma), steps, losses
+
+
+def repeat_batch(x, restarts):
+    """Repeat the batch dimension (dim 1) of a (T, B, ...) tensor restarts times, restart major."""
+    return x.repeat(*([1, restarts] + [1] * (x.dim() - 2)))
+
+
+@nem.capture
+def restart_nem_iterations(nem_cell, input_data, target_data, k, nr_steps, pixel_dist, restarts,
+                           collisions=None, actions=None):
+    """Run all EM steps from several random gamma initializations and keep the best per sample.
+
+    The restarts are folded into the batch dimension of a single run, and each
+    restart of a sample is scored by its total loss after the last step.
+
+    :return: the (h, pred, gamma) of the best restart of every sample, its
+        total loss (B,) and its restart index (B,)
+    """
+    assert not nem_cell.training, 'restarts need the batch independent eval mode'
+    prior = compute_prior(distribution=pixel_dist)
+    batch_size = list(input_data.size())[1]
+
+    with torch.no_grad():
+        hidden_state = nem_cell.init_state(restarts * batch_size, k, dtype=torch.float32)
+        input_data, target_data = repeat_batch(input_data, restarts), repeat_batch(target_data, restarts)
+        collisions = None if collisions is None else repeat_batch(collisions, restarts)
+        actions = None if actions is None else repeat_batch(actions, restarts)
+
+        h, pred, gamma, _, _ = run_em_steps(nem_cell, 0, nr_steps, *hidden_state, input_data=input_data,
+                                            target_data=target_data, prior=prior, pixel_dist=pixel_dist,
+                                            collisions=collisions, actions=actions, scored_steps=[])
+
+        losses = sample_losses(pred, gamma, target_data[nr_steps], prior, pixel_distribution=pixel_dist)
+        losses, best = torch.min(losses.view(restarts, batch_size), 0)
+        index = best * batch_size + torch.arange(batch_size, device=best.device)
+
+    h = h.view(restarts * batch_size, k, -1)[index].view(batch_size * k, -1)
+    return (h, pred[index], gamma[index]), losses, best
+
+
+@nem.capture
+@torch.no_grad()
+def rollout_nem_iterations(nem_cell, input_data, target_data, rollout_steps, k, hidden_state=None):
+    """Run the EM steps over a sequence and feed back the own predictions for the last rollout_steps.
+
+    The first T - 1 - rollout_steps steps observe input_data and compute the
+    gammas against target_data (burn-in), like static_nem_iterations. Every
+    rollout step feeds the predicted frame of the previous step back as input,
+    and the gammas are computed against the frame it predicts next. No loss or
+    score is computed.
+
+    The frame predicted at every step is the predictions mixed with the gammas
+    of the previous step, so it does not depend on the frame it predicts. It
+    is written to one buffer that is only valid until the next step.
+
+    :param input_data: (T, B, 1, W, H, C), e.g. the corrupted features
+    :param target_data: (T, B, 1, W, H, C), e.g. the true features
+    :param hidden_state: (h, pred, gamma) to start from, drawn fresh if None
+    :return: generator of (t, pred, gamma, frame) for t = 0 ... T - 2, where
+        pred and the predicted frame (B, 1, W, H, C) are for frame t + 1
+    """
+    nr_steps = list(input_data.size())[0] - 1
+    burn_in = max(nr_steps - rollout_steps, 0)
+    if hidden_state is None:
+        hidden_state = nem_cell.init_state(list(input_data.size())[1], k, dtype=torch.float32)
+
+    frame = torch.empty_like(target_data[0])
+    for t in range(nr_steps):
+        gamma_old = hidden_state[2]
+        if t < burn_in:
+            hidden_state, _ = nem_cell.forward((input_data[t], target_data[t+1]), hidden_state)
+            torch.sum(gamma_old * hidden_state[1], 1, keepdim=True, out=frame)
+        else:
+            # the first rollout step still observes its input frame
+            h, pred = nem_cell.predict(input_data[t] if t == burn_in else frame, hidden_state)
+            torch.sum(gamma_old * pred, 1, keepdim=True, out=frame)
+            hidden_state = (h, pred, nem_cell.e_step(pred, frame))
+        yield t, hidden_state[1], hidden_state[2], frame
+
 
+def steps_histogram(steps, nr_steps):
+    """Number of samples that used 0, 1, ..., nr_steps EM steps."""
+    return np.bincount(np.asarray(steps).ravel(), minlength=nr_steps + 1)
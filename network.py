@@ -2,8 +2,11 @@
 # coding=utf-8
 from __future__ import division, print_function, unicode_literals
 
+import contextlib
+import copy
 import numpy as np
 import torch
+from torch.utils.checkpoint import checkpoint
 
 from sacred import Ingredient
 
@@ -45,6 +48,9 @@ def cfg():
         {'name': 'r_conv', 'in_shape' : (32,32), 'size_in' : 16, 'size': 1, 'act': 'sigmoid', 'stride': (2, 2), 'kernel': (5, 5)},
         {'name': 'reshape', 'shape': [-1]},
     ]
+    interaction = 'dense'       # {dense, factorized}: factorized projects the first core layer per object, not per pair
+    neighbours = None           # interact with the m nearest objects by gamma centroid instead of all K-1 (None = dense)
+    checkpoint = False          # recompute the activations of the sub-modules in backward instead of keeping them
 
 # encoder decoder pairs
 
@@ -173,6 +179,10 @@ class LayerWrapper(torch.nn.Module):
             input = self._transform(input)
         output = self._layer(input)
         del input
+        return self.norm_act(output)
+
+    def norm_act(self, output):
+        """Apply the normalization and activation that follow the layer."""
         if self._ln != None:
             output = self._ln(output)
         if self._act!=None:
@@ -181,10 +191,88 @@ class LayerWrapper(torch.nn.Module):
 
 
 
+def fold_batch_norm(wrapper):
+    """Fold the eval-mode BatchNorm of a LayerWrapper into the weights of its Linear/Conv2d layer."""
+    layer, bn = wrapper._layer, wrapper._ln
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = layer.bias if layer.bias is not None else torch.zeros_like(bn.running_mean)
+    shape = [-1] + [1] * (layer.weight.dim() - 1)
+    layer.weight = torch.nn.Parameter(layer.weight * scale.view(shape))
+    layer.bias = torch.nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+    wrapper._ln = None
+
+
+def optimize_for_inference(module, inplace=False):
+    """Freeze a module (e.g. R_NEM) for evaluation and serving.
+
+    The BatchNorm of every LayerWrapper is folded into the preceding layer and
+    its ReLU/ELU activations run in place, which gives the same outputs as
+    module in eval mode with fewer ops and intermediate tensors. The result is
+    in eval mode without gradients and cannot be trained or saved as a
+    checkpoint of module.
+
+    :param inplace: change module itself instead of a copy
+    """
+    if not inplace:
+        module = copy.deepcopy(module)
+    module.eval()
+    with torch.no_grad():
+        for wrapper in module.modules():
+            if not isinstance(wrapper, LayerWrapper):
+                continue
+            if wrapper._ln is not None and getattr(wrapper, '_layer', None) is not None:
+                fold_batch_norm(wrapper)
+            if isinstance(wrapper._act, (torch.nn.ReLU, torch.nn.ELU)):
+                wrapper._act.inplace = True
+    for p in module.parameters():
+        p.requires_grad_(False)
+    return module
+
+
+@contextlib.contextmanager
+def frozen_batch_norm_stats(module):
+    """Keep the BatchNorm running statistics of module unchanged.
+
+    Used while recomputing checkpointed activations, so a batch is not
+    accumulated into the running statistics twice.
+    """
+    bns = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    saved = [(bn.momentum, bn.num_batches_tracked.clone() if bn.num_batches_tracked is not None else None) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, (momentum, tracked) in zip(bns, saved):
+            bn.momentum = momentum
+            if tracked is not None:
+                bn.num_batches_tracked.copy_(tracked)
+
+
+def checkpointed(module, fn, *args):
+    """Run fn(*args) without keeping its activations; they are recomputed in backward."""
+    return checkpoint(fn, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), frozen_batch_norm_stats(module)))
+
+
+def gather_partners(x, index):
+    """Gather the partners of every object.
+
+    :param x: per-object values (b, K, h)
+    :param index: partner ids shared by the batch (K, n) or per sample (b, K, n)
+    :return: (b, K, n, h)
+    """
+    if index.dim() == 2:
+        return x[:, index]
+    batch = torch.arange(x.size()[0], device=x.device).view(-1, 1, 1)
+    return x[batch, index]
+
+
 # R-NEM CELL
 class R_NEM(torch.nn.Module):
     @net.capture
-    def __init__(self, K, input, output, recurrent, actions=None, name='NPE'):
+    def __init__(self, K, input, output, recurrent, interaction='dense', neighbours=None, checkpoint=False,
+                 actions=None, name='NPE'):
         super(R_NEM, self).__init__()
         self._encoder = recurrent[0]["encoder"]
         self._core = recurrent[0]["core"]
@@ -194,6 +282,13 @@ class R_NEM(torch.nn.Module):
         self._recurrent = recurrent
         self._K = K
         self._name = name
+        self._interaction = interaction
+        self._neighbours = neighbours if neighbours is not None and neighbours < K - 1 else None
+        self._checkpoint = checkpoint
+        if interaction not in ('dense', 'factorized'):
+            raise KeyError('Unknown interaction: "{}"'.format(interaction))
+        if interaction == 'factorized':
+            assert self._core[0]['name'] == 'fc', 'factorized interactions need an fc first core layer'
 
         mods = [LayerWrapper(mod) for mod in input]
         self._input_wrapper = torch.nn.Sequential(*mods)
@@ -216,6 +311,9 @@ class R_NEM(torch.nn.Module):
         mods = [LayerWrapper(mod) for mod in self._recurrent]
         self._recurrent_wrapper = torch.nn.Sequential(*mods)
 
+        # cached gather indices for the pairwise interactions, keyed by (K, device)
+        self._partner_indices = {}
+
     @property
     def state_size(self):
         return self._recurrent[0]['size']
@@ -224,6 +322,11 @@ class R_NEM(torch.nn.Module):
     def output_size(self):
         return self._recurrent[0]['size']
 
+    @property
+    def neighbours(self):
+        """Number of partners per object for sparse interactions, None if dense."""
+        return self._neighbours
+
     def init_hidden(self, batch_size):
         # variable of size [num_layers*num_directions, b_sz, hidden_sz]
         if torch.cuda.is_available():
@@ -231,54 +334,186 @@ class R_NEM(torch.nn.Module):
         else:
             return torch.autograd.Variable(torch.zeros(batch_size, self.state_size))
 
-    def forward(self, inputs, state):
-        b = int(inputs.size()[0]/self._K)
-        k = self._K
-        m = inputs.size()[1]
-
-        inputs = self._input_wrapper(inputs)
-
-        state1 = self._encoder_wrapper(state)
-        state1r = state1.view(b,self._K,-1)
-        state1rr = state1.view(b,self._K,1,-1)
-
-        fs = state1rr.repeat(1,1,self._K-1,1)
-        #state1rl = torch.unbind(state1r,1)
-
-        if k > 1:
-            csu = []
-            for i in range(k):
-                selector = [j for j in range(k) if j != i]
-                tensor = torch.LongTensor
-                if torch.cuda.is_available():
-                    tensor = torch.cuda.LongTensor
-                c = torch.index_select(state1r, 1, tensor(selector))
-                #c = list(np.take(state1rl, selector))  # list of length k-1 of (b, h1)
-                #c = torch.stack(c, dim=1)     # (b, k-1, h1)
-                csu.append(c)
-
-            cs = torch.stack(csu, dim=1)    # (b, k, k-1, h1)   
+    def _partner_index(self, k, device):
+        """Return the (k, k-1) index of the objects each object interacts with.
+
+        Row i holds all object ids except i, in increasing order. The index is
+        built once per (K, device) and reused for every EM step.
+        """
+        key = (k, str(device))
+        index = self._partner_indices.get(key)
+        if index is None:
+            others = torch.arange(k - 1, device=device).view(1, k - 1)
+            focus = torch.arange(k, device=device).view(k, 1)
+            index = others + (others >= focus).long()
+            self._partner_indices[key] = index
+        return index
+
+    def _run(self, fn, *args):
+        """Run fn(*args), checkpointed if enabled and gradients are needed."""
+        if self._checkpoint and self.training and torch.is_grad_enabled():
+            return checkpointed(self, fn, *args)
+        return fn(*args)
+
+    def _factorized_core(self, state1r, index):
+        """Apply the core stack to all (context, focus) pairs given by index.
+
+        The first core layer is linear in cat(cs, fs), so its context and focus
+        halves are projected once per object (b*K rows) and broadcast-added per
+        pair instead of running the matmul on b*K*(K-1) rows. In eval mode the
+        following BatchNorm is folded into both projections as well.
+
+        :param state1r: (b, K, h1)
+        :param index: (K, n) or (b, K, n)
+        :return: core output (b*K*n, size)
+        """
+        first = self._core_wrapper[0]
+        h1 = state1r.size()[2]
+        weight = first._layer.weight
+        pc = torch.nn.functional.linear(state1r, weight[:, :h1])
+        pf = torch.nn.functional.linear(state1r, weight[:, h1:], first._layer.bias)
+
+        ln = first._ln
+        folded = ln is not None and not ln.training
+        if folded:
+            scale = ln.weight / torch.sqrt(ln.running_var + ln.eps)
+            pc = pc * scale
+            pf = (pf - ln.running_mean) * scale + ln.bias
+
+        core_out = gather_partners(pc, index) + pf.unsqueeze(2)     # (b, K, n, size)
+        core_out = core_out.view(-1, core_out.size()[3])
+        del pc, pf
+
+        if not folded:
+            core_out = first.norm_act(core_out)
+        elif first._act is not None:
+            core_out = first._act(core_out)
+        return self._core_wrapper[1:](core_out)
+
+    def _interact(self, state1r, index):
+        """Compute the attention-weighted effect of the partners on each object.
+
+        :param state1r: encoded objects (b, K, h1)
+        :param index: partners of each object, either shared (K, n) or per
+            sample (b, K, n)
+        :return: summed effects (b*K, size)
+        """
+        b, k = list(state1r.size())[:2]
+        n = index.size()[-1]
+
+        if self._interaction == 'factorized':
+            core_out = self._factorized_core(state1r, index)
         else:
-            cs = torch.zeros(b, k, k-1, h1)
-
-        cs = cs.view(b*self._K*(self._K-1),-1)
-        fs = fs.view(b*self._K*(self._K-1),-1)
-
-        core_out = torch.cat((cs,fs),dim=1)
-
-        core_out = self._core_wrapper(core_out)
+            # gather context (b, k, n, h1) and broadcast focus (b, k, n, h1) objects
+            cs = gather_partners(state1r, index)
+            fs = state1r.view(b, k, 1, -1).expand_as(cs)
+            core_out = torch.cat((cs, fs), dim=3).view(b*k*n, -1)
+            core_out = self._core_wrapper(core_out)
+            del cs, fs
 
         context = self._context_wrapper(core_out)
-        contextr = context.view(b*self._K, self._K-1, -1)
+        contextr = context.view(b*k, n, -1)
 
         attention = self._att_wrapper(core_out)
-        attentionr = attention.view(b*k, k-1, 1)
+        attentionr = attention.view(b*k, n, 1)
         effectrsum = torch.sum(torch.mul(attentionr, contextr), dim=1)
+        del attention, attentionr, contextr, context, core_out
+
+        return effectrsum
+
+    def _edge_interact(self, state1, src, dst):
+        """Compute the attention-weighted effects along an edge list.
+
+        :param state1: encoded objects (m, h1)
+        :param src: partner (context) object of every edge (E,)
+        :param dst: focus object of every edge (E,)
+        :return: summed effects on every object (m, size)
+        """
+        if self._interaction == 'factorized':
+            first = self._core_wrapper[0]
+            h1 = state1.size()[1]
+            weight = first._layer.weight
+            pc = torch.nn.functional.linear(state1, weight[:, :h1])
+            pf = torch.nn.functional.linear(state1, weight[:, h1:], first._layer.bias)
+            core_out = self._core_wrapper[1:](first.norm_act(pc[src] + pf[dst]))
+        else:
+            core_out = self._core_wrapper(torch.cat((state1[src], state1[dst]), dim=1))
+
+        effect = self._att_wrapper(core_out) * self._context_wrapper(core_out)
+        return effect.new_zeros(state1.size()[0], effect.size()[1]).index_add_(0, dst, effect)
+
+    def _forward_pruned(self, inputs, state, alive, neighbours=None):
+        """Run one step on the alive objects only.
+
+        Dead objects are left out of the input, encoder, interaction and output
+        stacks, and alive objects only interact with alive partners. The state
+        of dead objects is carried over and their output is zero.
+
+        :param alive: (b, K) bool
+        """
+        b, k = list(alive.size())
+        rows = alive.view(-1).nonzero().squeeze(1)
+
+        x = self._input_wrapper(inputs[rows])
+
+        # the relational stacks run in float32, see forward
+        with torch.autocast(x.device.type, enabled=False):
+            state1 = self._encoder_wrapper(state[rows])
+
+            # edges between alive (focus, partner) pairs, numbered by their alive row
+            index = self._partner_index(k, alive.device).expand(b, k, k - 1) if neighbours is None else neighbours
+            n = index.size()[2]
+            batch = torch.arange(b, device=alive.device).view(b, 1, 1).expand(b, k, n)
+            focus = torch.arange(k, device=alive.device).view(1, k, 1).expand(b, k, n)
+            valid = alive[batch, focus] & alive[batch, index]
+            alive_row = torch.cumsum(alive.view(-1).long(), 0) - 1
+            dst = alive_row[(batch * k + focus)[valid]]
+            src = alive_row[(batch * k + index)[valid]]
+
+            effectrsum = self._edge_interact(state1, src, dst)
+            new_state = self._recurrent_wrapper(torch.cat((state1, effectrsum, x.float()), dim=1))
+        output = self._output_wrapper(new_state)
+
+        full_state = state.clone()
+        full_state[rows] = new_state
+        full_output = output.new_zeros((b * k,) + output.size()[1:])
+        full_output[rows] = output
+        return full_output, full_state
+
+    def forward(self, inputs, state, neighbours=None, alive=None):
+        """Run one step of the relational cell.
+
+        :param inputs: (b*K, M)
+        :param state: (b*K, state_size)
+        :param neighbours: optional (b, K, m) ids of the objects each object
+            interacts with. Defaults to all K-1 other objects.
+        :param alive: optional (b, K) bool mask of the objects to compute, see
+            _forward_pruned. All objects are computed if None.
+        """
+        if alive is not None and self._K > 1:
+            return self._forward_pruned(inputs, state, alive, neighbours)
+
+        b = int(inputs.size()[0]/self._K)
+        k = self._K
+
+        inputs = self._run(self._input_wrapper, inputs)
+
+        # the encoder, interaction and recurrent stacks always run in float32: under a bf16 autocast
+        # the cancelling per-row gradients of their BatchNorms lose too much precision
+        with torch.autocast(inputs.device.type, enabled=False):
+            state1 = self._encoder_wrapper(state)
+            state1r = state1.view(b, k, -1)
 
-        total = torch.cat((state1, effectrsum, inputs), dim=1)
+            if k > 1:
+                index = self._partner_index(k, state1r.device) if neighbours is None else neighbours
+                effectrsum = self._run(self._interact, state1r, index)
+            else:
+                # a single object has no interactions
+                effectrsum = state1.new_zeros(b*k, self._context[-1]['size'])
 
-        new_state = self._recurrent_wrapper(total)
-        del attention, attentionr, contextr, context, core_out, total, cs, fs, inputs, state1, state1r, state1rr, effectrsum
+            total = torch.cat((state1, effectrsum, inputs.float()), dim=1)
 
-        return self._output_wrapper(new_state), new_state
+            new_state = self._recurrent_wrapper(total)
+        del total, inputs, state1, state1r, effectrsum
 
+        return self._run(self._output_wrapper, new_state), new_state
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding=utf-8
+from __future__ import division, print_function, unicode_literals, absolute_import
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from datasets import pack_bits, unpack_bits
+
+# binary noise as the probability of a one given the pixel x: a + b*x
+BINARY_NOISE = {
+    'bitflip': lambda prob: (prob, 1. - 2. * prob),             # flip every pixel with prob
+    'salt_pepper': lambda prob: (prob / 2., 1. - prob),         # replace every pixel with a random bit with prob
+}
+NOISE_TYPES = sorted(BINARY_NOISE) + ['masking']                # masking: zero every pixel with prob
+
+
+def batch_generator(seed, key, device=None):
+    """Return a torch.Generator on device seeded from seed and a key of non-negative ints."""
+    state = np.random.SeedSequence([seed] + [int(k) for k in key]).generate_state(2)
+    generator = torch.Generator(device=device if device is not None else 'cpu')
+    generator.manual_seed((int(state[0]) << 31) ^ int(state[1]))
+    return generator
+
+
+class Noise(object):
+    """Corrupt batches with noise drawn from a dedicated random stream.
+
+    Every batch draws its noise from a generator seeded from seed, the epoch
+    and a batch key, so a batch gets the same noise whenever it is seen again
+    in the same epoch and validation (epoch None) gets the same noise in every
+    epoch without storing it. The noise is sampled on the device of the data,
+    and the object can be pickled to DataLoader workers (see NoisyDataset).
+
+    bitflip and salt_pepper expect binary data and sample the corrupted pixel
+    in a single bernoulli draw; masking works for any data.
+    """
+    def __init__(self, noise_type='bitflip', prob=0.2, seed=0):
+        if noise_type in ['None', 'none']:
+            noise_type = None
+        if noise_type is not None and noise_type not in NOISE_TYPES:
+            raise KeyError('Unknown noise type "{}", use one of {}'.format(noise_type, NOISE_TYPES))
+        self.noise_type = noise_type
+        self.prob = prob
+        self.seed = seed
+        self.epoch = None
+
+    def generator(self, key, device=None):
+        epoch = 0 if self.epoch is None else self.epoch + 1
+        return batch_generator(self.seed, [epoch] + list(key), device)
+
+    def __call__(self, data, key=(), generator=None):
+        """
+        :param data: (...) tensor to corrupt
+        :param key: ints identifying the batch within the epoch
+        :param generator: torch.Generator on the device of data overriding the one for key
+        """
+        if self.noise_type is None or self.prob == 0:
+            return data
+        generator = generator or self.generator(key, data.device)
+
+        if self.noise_type == 'masking':
+            keep = torch.empty_like(data).bernoulli_(1. - self.prob, generator=generator)
+            return keep.mul_(data)
+
+        a, b = BINARY_NOISE[self.noise_type](self.prob)
+        return torch.bernoulli(data * b + a, generator=generator)
+
+
+class NoisyDataset(Dataset):
+    """Dataset wrapper that corrupts the features in the DataLoader workers.
+
+    Batches are returned with the corruption appended in compact form, keyed by
+    the index of the batch: the bit-packed corrupted pixels for binary noise and
+    the bit-packed mask of the non-zero corrupted pixels otherwise, so workers
+    hand over bytes instead of float32 frames. corrupted() expands it, usually
+    on the device. Other attributes are those of the wrapped dataset.
+    """
+    def __init__(self, dataset, noise):
+        self.dataset = dataset
+        self.noise = noise
+
+    def __getattr__(self, name):
+        if name in ('dataset', 'noise'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        data = self.dataset[index]
+        key = list(index[0]) + [index[1]] if isinstance(index, tuple) else [index]
+        features = self.dataset.unpack(data[:1])[0]
+        corrupted = self.noise(features, key)
+        return list(data) + [pack_bits(corrupted if self._binary else corrupted != 0)]
+
+    @property
+    def _binary(self):
+        return self.noise.noise_type in BINARY_NOISE and self.noise.prob != 0
+
+    def corrupted(self, features, packed):
+        """Expand the packed corruption of a batch to float corrupted features on the device of features.
+
+        :param features: (..., W, H, C) unpacked float features of the batch
+        """
+        bits = unpack_bits(packed.to(features.device), list(features.size())[-3:]).float()
+        # masking only zeroes pixels, so the corrupted features are the features where the mask is set
+        return bits if self._binary else bits.mul_(features)
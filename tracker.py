@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Online tracking of objects in many concurrent frame streams with a trained NEMCell.
+
+Every stream keeps its own (h, pred, gamma) between frames. Frames submitted
+from any thread are collected on a worker thread and the pending frames of
+different streams are run through the cell in one batch, e.g.
+
+    with StreamTracker(nem_cell, k=5) as tracker:
+        masks, preds = tracker.track('camera-1', frame)
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class Session(object):
+    """State of one stream: the (h, pred, gamma) after its last frame and that frame."""
+    __slots__ = ('h', 'pred', 'gamma', 'frame', 'last_seen')
+
+    def __init__(self, h, pred, gamma):
+        self.h, self.pred, self.gamma = h, pred, gamma
+        self.frame = None
+        self.last_seen = time.time()
+
+
+class StreamTracker(object):
+    """Run one EM step per submitted frame, micro-batching the frames of different streams.
+
+    A batch is run as soon as max_batch frames of distinct streams are pending
+    or the oldest pending frame has waited max_latency seconds. Further frames
+    of a stream already in the batch wait for the next one, so the frames of
+    every stream are processed in order. Streams without a frame for
+    idle_timeout seconds are evicted and start from a fresh state.
+
+    Every frame is the target of the E-step of the step that consumes the
+    previous frame of its stream (the first frame of a stream is its own input).
+    The cell runs in eval mode, where every sample is independent of the others
+    in its batch. Pass a cell frozen with network.optimize_for_inference to
+    save the BatchNorm ops of every step.
+
+    :param nem_cell: trained NEMCell
+    :param k: number of components
+    """
+    def __init__(self, nem_cell, k, max_batch=64, max_latency=0.01, idle_timeout=60.):
+        self.nem_cell = nem_cell.eval()
+        self.k = k
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.idle_timeout = idle_timeout
+        self.device = next(nem_cell.parameters()).device
+
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._deferred = collections.deque()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def submit(self, stream_id, frame):
+        """Queue the next frame (W, H, C) of a stream.
+
+        :return: Future of the gammas (K, W, H, 1) and predictions (K, W, H, C) of
+            the stream after this frame
+        """
+        if self._closed:
+            raise RuntimeError('StreamTracker is closed')
+        future = Future()
+        frame = torch.as_tensor(frame, dtype=torch.float32).to(self.device)
+        self._pending.put((stream_id, frame.view([1] + list(self.nem_cell.input_shape)), future, time.time()))
+        return future
+
+    def track(self, stream_id, frame, timeout=None):
+        """Submit a frame and wait for its gammas and predictions."""
+        return self.submit(stream_id, frame).result(timeout)
+
+    def end(self, stream_id):
+        """Drop the state of a stream, its next frame starts a new session."""
+        with self._lock:
+            self.sessions.pop(stream_id, None)
+
+    def close(self):
+        """Process the frames submitted so far and stop the worker thread."""
+        if not self._closed:
+            self._closed = True
+            self._pending.put(None)
+            self._thread.join()
+
+    def _collect(self):
+        """Wait for pending frames and return up to max_batch of them from distinct streams.
+
+        :return: the batch, and whether the tracker was closed
+        """
+        items, closed = list(self._deferred), False
+        self._deferred.clear()
+        while not items:
+            try:
+                item = self._pending.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._evict()
+                continue
+            if item is None:
+                return [], True
+            items.append(item)
+
+        batch, streams = [], set()
+        deadline = items[0][3] + self.max_latency
+        while True:
+            for item in items:
+                if item[0] in streams or len(batch) == self.max_batch:
+                    self._deferred.append(item)
+                else:
+                    streams.add(item[0])
+                    batch.append(item)
+            items = []
+            timeout = deadline - time.time()
+            if len(batch) == self.max_batch or closed or timeout <= 0:
+                return batch, closed
+            try:
+                item = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                return batch, closed
+            if item is None:
+                closed = True
+            else:
+                items.append(item)
+
+    def _serve(self):
+        closed = False
+        while not closed or self._deferred:
+            batch, stop = self._collect()
+            closed = closed or stop
+            if not batch:
+                continue
+            try:
+                outputs = self._step([stream_id for stream_id, _, _, _ in batch], [frame for _, frame, _, _ in batch])
+            except BaseException as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+            self._evict()
+
+    def _step(self, stream_ids, frames):
+        """Run one EM step on the next frame (1, W, H, C) of every stream."""
+        k = self.k
+        with self._lock:
+            sessions = []
+            for stream_id in stream_ids:
+                if stream_id not in self.sessions:
+                    state = self.nem_cell.init_state(1, k, dtype=torch.float32)
+                    self.sessions[stream_id] = Session(*[x.to(self.device) for x in state])
+                sessions.append(self.sessions[stream_id])
+
+        with torch.no_grad():
+            targets = torch.stack(frames)
+            inputs = torch.stack([frame if s.frame is None else s.frame for s, frame in zip(sessions, frames)])
+            state = (torch.cat([s.h for s in sessions]), torch.cat([s.pred for s in sessions]),
+                     torch.cat([s.gamma for s in sessions]))
+            (h, pred, gamma), _ = self.nem_cell.forward((inputs, targets), state)
+
+        now = time.time()
+        outputs = []
+        for i, (session, frame) in enumerate(zip(sessions, frames)):
+            # copies, a view would keep the tensors of the whole batch alive
+            session.h, session.pred = h[i * k:(i + 1) * k].clone(), pred[i:i + 1].clone()
+            session.gamma = gamma[i:i + 1].clone()
+            session.frame, session.last_seen = frame, now
+            outputs.append((session.gamma[0], session.pred[0]))
+        return outputs
+
+    def _evict(self):
+        """Drop the sessions of streams without a frame for idle_timeout seconds."""
+        oldest = time.time() - self.idle_timeout
+        with self._lock:
+            for stream_id in [i for i, s in self.sessions.items() if s.last_seen < oldest]:
+                del self.sessions[stream_id]
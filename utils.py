@@ -9,7 +9,6 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import hsv_to_rgb
-from sklearn.metrics import adjusted_mutual_info_score
 
 
 def save_image(filename, image_array):
@@ -58,47 +57,184 @@ def parse_activation_function(name_list):
     return [ACTIVATION_FUNCTIONS[name] for name in name_list]
 
 
-def evaluate_groups_seq(true_groups, predicted, weights):
+def evaluate_groups_seq(true_groups, predicted, weights, processes=None):
     """ Compute the weighted AMI score and corresponding mean confidence for given gammas.
     :param true_groups: (T, B, 1, W, H, 1)
     :param predicted: (T, B, K, W, H, 1)
     :param weights: (T)
+    :param processes: see evaluate_groups
     :return: scores, confidences (B,)
     """
-    w_scores, w_confidences = 0., 0.
     assert true_groups.ndim == predicted.ndim == 6, true_groups.shape
+    T, B = predicted.shape[:2]
 
-    for t in range(true_groups.shape[0]):
-        scores, confidences = evaluate_groups(true_groups[t], predicted[t])
-
-        w_scores += weights[t] * np.array(scores)
-        w_confidences += weights[t] * np.array(confidences)
-
+    # score all steps at once
+    scores, confidences = evaluate_groups(true_groups.reshape((T * B,) + true_groups.shape[2:]),
+                                          predicted.reshape((T * B,) + predicted.shape[2:]), processes)
+    weights = np.asarray(weights, dtype=np.float64)[:T, None]
     norm = np.sum(weights)
 
+    w_scores = np.sum(weights * np.reshape(scores, (T, B)), axis=0)
+    w_confidences = np.sum(weights * np.reshape(confidences, (T, B)), axis=0)
     return w_scores/norm, w_confidences/norm
 
 
-def evaluate_groups(true_groups, predicted):
+def evaluate_groups(true_groups, predicted, processes=None):
     """ Compute the AMI score and corresponding mean confidence for given gammas.
     :param true_groups: (B, 1, W, H, 1)
     :param predicted: (B, K, W, H, 1)
+    :param processes: number of worker processes to score large batches with (None: one per CPU)
     :return: scores, confidences (B,)
     """
-    scores, confidences = [], []
     assert true_groups.ndim == predicted.ndim == 5, true_groups.shape
     batch_size, K = predicted.shape[:2]
     true_groups = true_groups.reshape(batch_size, -1)
     predicted = predicted.reshape(batch_size, K, -1)
     predicted_groups = predicted.argmax(1)
     predicted_conf = predicted.max(1)
-    for i in range(batch_size):
-        true_group = true_groups[i]
-        idxs = np.where(true_group != 0.0)[0]
-        scores.append(adjusted_mutual_info_score(true_group[idxs], predicted_groups[i, idxs]))
-        confidences.append(np.mean(predicted_conf[i, idxs]))
+    mask = true_groups != 0.0
+
+    scores = adjusted_mutual_info(true_groups, predicted_groups, mask, processes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        confidences = np.sum(predicted_conf * mask, axis=1) / np.sum(mask, axis=1)
+
+    return list(scores), list(confidences)
+
+
+AMI_SAMPLES_PER_PROCESS = 256       # do not start worker processes for fewer samples than this
+AMI_CHUNK_ELEMENTS = 2**22          # bound on the elements of the EMI terms evaluated at once
 
-    return scores, confidences
+
+def adjusted_mutual_info(labels_true, labels_pred, mask=None, processes=None):
+    """AMI (arithmetic normalization, natural log) of many labelings at once.
+
+    Gives the same values as sklearn's adjusted_mutual_info_score applied to
+    every row, including the expected mutual information and its limit cases,
+    but computes the contingency tables with one bincount and sums the
+    expected mutual information over all rows and cell counts in vectorized
+    chunks. Large batches are split over a pool of worker processes.
+
+    :param labels_true: (S, N) true labels
+    :param labels_pred: (S, N) predicted labels
+    :param mask: (S, N) pixels to include (None: all)
+    :param processes: number of worker processes (None: one per CPU, 1: no pool)
+    :return: AMI scores (S,)
+    """
+    labels_true = np.asarray(labels_true)
+    labels_pred = np.asarray(labels_pred)
+    mask = np.ones(labels_true.shape, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    nr_samples = labels_true.shape[0]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, nr_samples // AMI_SAMPLES_PER_PROCESS)
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        splits = np.array_split(np.arange(nr_samples), processes)
+        with ProcessPoolExecutor(processes) as pool:
+            parts = pool.map(adjusted_mutual_info, [labels_true[s] for s in splits], [labels_pred[s] for s in splits],
+                             [mask[s] for s in splits], [1] * processes)
+            return np.concatenate(list(parts))
+
+    # contingency tables (S, G, K) over the masked pixels with labels mapped to 0, 1, ...
+    true, pred = label_ids(labels_true), label_ids(labels_pred)
+    nr_true, nr_pred = true.max(initial=0) + 1, pred.max(initial=0) + 1
+    index = (np.arange(nr_samples)[:, None] * nr_true + true) * nr_pred + pred
+    nij = np.bincount(index[mask], minlength=nr_samples * nr_true * nr_pred).reshape(nr_samples, nr_true, nr_pred)
+    nij = nij.astype(np.float64)
+    n = np.sum(nij, axis=(1, 2))
+    a = np.sum(nij, axis=2)
+    b = np.sum(nij, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_n = np.log(n)
+
+        # mutual information and entropies
+        log_a, log_b = np.log(a), np.log(b)
+        mi = nij / n[:, None, None] * (np.log(nij) - log_n[:, None, None]
+                                       - log_a[:, :, None] - log_b[:, None, :] + 2 * log_n[:, None, None])
+        mi = np.where((nij > 0) & (np.abs(mi) >= np.finfo(np.float64).eps), mi, 0.)
+        mi = np.clip(np.sum(mi, axis=(1, 2)), 0., None)
+        h_true = -np.sum(np.where(a > 0, a / n[:, None] * (log_a - log_n[:, None]), 0.), axis=1)
+        h_pred = -np.sum(np.where(b > 0, b / n[:, None] * (log_b - log_n[:, None]), 0.), axis=1)
+
+    emi = expected_mutual_info(a, b, n)
+
+    # limit cases as in sklearn
+    eps = np.finfo(np.float64).eps
+    denominator = (h_true + h_pred) / 2 - emi
+    denominator = np.where(denominator < 0, np.minimum(denominator, -eps), np.maximum(denominator, eps))
+    numerator = mi - emi
+    numerator = np.where(numerator < 0, np.minimum(numerator, -eps), np.maximum(numerator, eps))
+    ami = numerator / denominator
+
+    nr_classes, nr_clusters = np.sum(a > 0, axis=1), np.sum(b > 0, axis=1)
+    ami = np.where((nr_classes == 1) | (nr_clusters == 1), 0., ami)
+    ami = np.where((nr_classes == nr_clusters) & (nr_classes <= 1), 1., ami)
+    return ami
+
+
+def label_ids(labels, max_id=2**16):
+    """Map labels to ints 0, 1, ..., taking small non-negative int labels as they are."""
+    ids = labels.astype(np.int64)
+    if labels.size and (ids.min() < 0 or ids.max() >= max_id or np.any(ids != labels)):
+        _, ids = np.unique(labels, return_inverse=True)
+    return ids.reshape(labels.shape)
+
+
+def expected_mutual_info(a, b, n):
+    """Expected mutual information of random labelings with the given cluster sizes.
+
+    :param a: (S, G) sizes of the true classes
+    :param b: (S, K) sizes of the predicted clusters
+    :param n: (S,) number of labeled pixels
+    :return: EMI (S,)
+    """
+    from scipy.special import gammaln
+    emi = np.zeros(len(n))
+
+    # log(m!) for all counts that can occur
+    table = gammaln(np.arange(int(n.max(initial=0)) + 2) + 1)
+
+    def log_factorial(m):
+        return table[m.astype(np.int64)]
+
+    # every cell (i, j) sums over nij in [max(1, a_i + b_j - n), min(a_i, b_j)]
+    a, b, n = a[:, :, None, None], b[:, None, :, None], n[:, None, None, None]
+    start = np.maximum(1, a + b - n)
+    length = np.maximum(np.minimum(a, b) + 1 - start, 0)
+    max_length = length.max(axis=(1, 2, 3)).astype(np.int64)
+
+    # evaluate rows of similar range lengths together, padded to the longest in the chunk
+    order = np.argsort(max_length)
+    widths = np.maximum(max_length[order], 1)
+    budget = max(AMI_CHUNK_ELEMENTS // (a.shape[1] * b.shape[2]), 1)
+    i = 0
+    while i < len(order):
+        j = i + 1
+        while j < len(order) and (j - i + 1) * widths[j] <= budget:
+            j += 1
+        chunk, width = order[i:j], int(widths[j - 1])
+        i = j
+
+        ca, cb, cn, cs = a[chunk], b[chunk], n[chunk], start[chunk]
+        nij = cs + np.arange(width)
+        valid = nij < cs + length[chunk]
+        nij = np.where(valid, nij, 1.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            term1 = nij / cn
+            term2 = np.log(cn) + np.log(nij) - np.log(ca) - np.log(cb)
+            gln = (log_factorial(ca) + log_factorial(cb) + log_factorial(cn - ca) + log_factorial(cn - cb)
+                   - log_factorial(nij) - log_factorial(cn) - log_factorial(np.where(valid, ca - nij, 0))
+                   - log_factorial(np.where(valid, cb - nij, 0))
+                   - log_factorial(np.where(valid, cn - ca - cb + nij, 0)))
+            terms = term1 * term2 * np.exp(np.where(valid, gln, -np.inf))
+            terms = np.where(valid, terms, 0.)
+        emi[chunk] = np.sum(terms, axis=(1, 2, 3))
+
+    # any labelling with zero entropy implies EMI = 0
+    single = (np.sum(a > 0, axis=(1, 2, 3)) <= 1) | (np.sum(b > 0, axis=(1, 2, 3)) <= 1)
+    return np.where(single, 0., emi)
 
 
 def color_spines(ax, color, lw=2):